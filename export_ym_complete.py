@@ -13,13 +13,26 @@ import json
 import logging
 import argparse
 from datetime import datetime
-from urllib.parse import urlencode
-from io import StringIO
+from urllib.parse import urlencode, quote
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 import pandas as pd
 
-from some_funcs import simple_ch_client
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    # pyarrow is optional, pandas' own parser and TSV inserts are used without it
+    pa = None
+    pacsv = None
+
+from some_funcs import (
+    simple_ch_client, FIELD_ERROR_RE, validate_fields_cached,
+    json_loads, poll_delay, ym_session, insert_compression, iter_arrow_stream
+)
 
 # Configure logging
 logging.basicConfig(
@@ -42,6 +55,32 @@ class ClickHouseError(Exception):
 class YMCompleteExporter:
     """Exports Yandex Metrica data to ClickHouse with all available fields"""
 
+    # Number of concurrent evaluate probes when searching for unavailable fields
+    VALIDATION_WORKERS = 16
+    # Fields per evaluate probe before falling back to single-field probes
+    VALIDATION_GROUP_SIZE = 8
+
+    # Number of parts streamed from the Logs API into ClickHouse in parallel
+    STREAM_WORKERS = 8
+
+    # Number of parts downloaded in parallel on the pandas upload path
+    DOWNLOAD_WORKERS = 4
+
+    # Rows serialized per TSV chunk on the pandas upload path
+    TSV_CHUNK_ROWS = 100_000
+
+    # Default rows per INSERT (config key ch_batch_size)
+    CH_BATCH_SIZE = 100_000
+
+    # Parse dtypes for the pandas upload path, by ClickHouse column type.
+    # Anything not listed (String, Date, DateTime) is kept as text, which skips
+    # type inference and passes values through to ClickHouse unchanged
+    PARSE_DTYPES = {
+        'UInt64': 'uint64',
+        'UInt32': 'uint32',
+        'UInt8': 'uint8'
+    }
+
     # Complete list of fields - HITS (8 fields from notebooks)
     HITS_FIELDS = (
         'ym:pv:browser',
@@ -225,6 +264,13 @@ class YMCompleteExporter:
         self.ch_client = None
         self.available_hits_fields = []
         self.available_visits_fields = []
+        # Memoized evaluate results: (source, frozenset(fields)) -> possible
+        self._evaluation_cache = {}
+        # Constant URL parts, built once instead of on every API call
+        self._counter_url = f"{self.api_host}/management/v1/counter/{config.get('ym_counter_id')}"
+        self._query_prefixes = {}
+        # Pool size covers the parallel evaluate probes and part downloads
+        self._session = ym_session(config.get('ym_token'), pool_maxsize=self.VALIDATION_WORKERS)
 
     def validate_config(self):
         """Validate required configuration parameters"""
@@ -275,108 +321,139 @@ class YMCompleteExporter:
         """
         Validate that all specified fields are available for the counter.
 
-        Args:
-            source: 'hits' or 'visits'
-            fields: tuple of field names
-
         Returns:
             tuple: (available_fields, unavailable_fields)
         """
-        logger.info(f"Validating {len(fields)} fields for {source}...")
+        return validate_fields_cached(self.config, source, fields, self._probe_fields)
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
+    def _probe_fields(self, source, fields):
+        """
+        Validate fields against the evaluate endpoint.
 
-        # Test all fields together first
-        url_params = urlencode([
-            ('date1', self.config['start_date']),
-            ('date2', self.config['end_date']),
-            ('source', source),
-            ('fields', ','.join(fields))
-        ])
+        Returns:
+            tuple: (available_fields, unavailable_fields, conclusive), where
+            conclusive is False unless every unavailable field was refused
+            by the API with an error naming it (and at least one was, once
+            the all-fields probe failed)
+        """
+        try:
+            # Test all fields together first
+            if self._evaluate_fields(source, fields, timeout=30) == 'possible':
+                logger.info(f"✓ All {len(fields)} fields are available for {source}")
+                return list(fields), [], True
 
-        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
+            logger.warning(f"Cannot create log request for {source} with all fields")
 
-        try:
-            response = requests.get(url, headers=header_dict, timeout=30)
-
-            if response.status_code == 200:
-                result = response.json().get('log_request_evaluation', {})
-                if result.get('possible', False):
-                    logger.info(f"✓ All {len(fields)} fields are available for {source}")
-                    return list(fields), []
-                else:
-                    logger.warning(f"Cannot create log request for {source}, testing individually...")
-            else:
-                logger.warning(f"Field validation failed for {source}, testing individually...")
-
-            # Test fields individually
-            available = []
-            unavailable = []
-
-            logger.info(f"Testing fields individually for {source}...")
-            for field in fields:
-                url_params = urlencode([
-                    ('date1', self.config['start_date']),
-                    ('date2', self.config['end_date']),
-                    ('source', source),
-                    ('fields', field)
-                ])
-
-                url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
-                response = requests.get(url, headers=header_dict, timeout=10)
-
-                if response.status_code == 200:
-                    result = response.json().get('log_request_evaluation', {})
-                    if result.get('possible', False):
-                        available.append(field)
-                        logger.info(f"  ✓ {field}")
-                    else:
-                        unavailable.append(field)
-                        logger.warning(f"  ✗ {field} - not possible")
-                else:
-                    unavailable.append(field)
-                    logger.warning(f"  ✗ {field} - error")
-
-            return available, unavailable
+            # Narrow the field set down to the fields that break the request
+            logger.info(f"Searching for unavailable fields for {source}...")
+            unavailable = self._find_unavailable_fields(source, fields)
+            available = [field for field in fields if field not in unavailable]
+
+            # With no field to blame, the bulk failure is unexplained
+            conclusive = bool(unavailable)
+            for field, outcome in unavailable.items():
+                logger.warning(f"  ✗ {field} - {'not available' if outcome == 'refused' else 'evaluate failed'}")
+                conclusive = conclusive and outcome == 'refused'
+
+            return available, list(unavailable), conclusive
 
         except requests.RequestException as e:
             raise YandexMetricaAPIError(f"Failed to validate fields: {e}")
 
+    def _find_unavailable_fields(self, source, fields):
+        """
+        Find unavailable fields by probing them in groups.
+
+        Fields are probed in groups of VALIDATION_GROUP_SIZE in parallel;
+        only members of groups that fail are then probed one by one, so the
+        usual case of a couple of bad fields costs a few dozen evaluate
+        requests instead of one per field.
+
+        Returns:
+            dict: unavailable field -> its single-field evaluate outcome,
+            in the original field order
+        """
+        size = self.VALIDATION_GROUP_SIZE
+        groups = [fields[i:i + size] for i in range(0, len(fields), size)]
+
+        def probe(subset):
+            return self._evaluate_fields(source, subset)
+
+        with ThreadPoolExecutor(max_workers=self.VALIDATION_WORKERS) as executor:
+            suspects = [
+                field
+                for group, outcome in zip(groups, executor.map(probe, groups)) if outcome != 'possible'
+                for field in group
+            ]
+            results = executor.map(probe, [(field,) for field in suspects])
+            unavailable = {field: outcome for field, outcome in zip(suspects, results) if outcome != 'possible'}
+
+        return {field: unavailable[field] for field in fields if field in unavailable}
+
+    def _evaluate_fields(self, source, fields, timeout=10):
+        """
+        Check via the evaluate endpoint whether a log request with these fields is possible.
+
+        Returns:
+            str: 'possible'; 'refused' when the API rejects the request with
+            an error naming one of the fields; 'failed' for anything else
+            (possible=False, other errors), which says nothing about the fields
+        """
+        cache_key = (source, frozenset(fields))
+        if cache_key in self._evaluation_cache:
+            return self._evaluation_cache[cache_key]
+
+        url = f"{self._counter_url}/logrequests/evaluate?{self._query_prefix(source)}{quote(','.join(fields), safe='')}"
+        response = self._session.get(url, timeout=timeout)
+
+        outcome = 'failed'
+        if response.status_code == 200:
+            result = json_loads(response.content).get('log_request_evaluation', {})
+            if result.get('possible', False):
+                outcome = 'possible'
+        elif response.status_code == 400:
+            # Not JSON (ValueError) or not a JSON object (AttributeError)
+            try:
+                message = json_loads(response.content).get('message', '')
+            except (ValueError, AttributeError):
+                message = ''
+            if not set(FIELD_ERROR_RE.findall(message)).isdisjoint(fields):
+                outcome = 'refused'
+
+        self._evaluation_cache[cache_key] = outcome
+        return outcome
+
+    def _query_prefix(self, source):
+        """Return the urlencoded date/source query for source, ending with 'fields='"""
+        if source not in self._query_prefixes:
+            self._query_prefixes[source] = urlencode([
+                ('date1', self.config['start_date']),
+                ('date2', self.config['end_date']),
+                ('source', source)
+            ]) + '&fields='
+        return self._query_prefixes[source]
+
     def create_logs_request(self, source, fields):
         """Create Logs API request and return request_id"""
         logger.info(f"Creating Logs API request for {source}...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
-
-        url_params = urlencode([
-            ('date1', self.config['start_date']),
-            ('date2', self.config['end_date']),
-            ('source', source),
-            ('fields', ','.join(sorted(fields, key=lambda s: s.lower())))
-        ])
-
-        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests?{url_params}"
+        fields_param = quote(','.join(sorted(fields, key=lambda s: s.lower())), safe='')
+        url = f"{self._counter_url}/logrequests?{self._query_prefix(source)}{fields_param}"
 
         try:
-            response = requests.post(url, headers=header_dict, timeout=30)
+            response = self._session.post(url, timeout=30)
 
             if response.status_code != 200:
                 error_msg = f"API returned status {response.status_code}"
                 try:
-                    error_data = response.json()
+                    error_data = json_loads(response.content)
                     if 'message' in error_data:
                         error_msg += f": {error_data['message']}"
                 except:
                     error_msg += f". Response: {response.text[:200]}"
                 raise YandexMetricaAPIError(error_msg)
 
-            request_id = response.json()['log_request']['request_id']
+            request_id = json_loads(response.content)['log_request']['request_id']
             logger.info(f"✓ Logs API request created for {source} with ID: {request_id}")
             return request_id
 
@@ -387,28 +464,28 @@ class YMCompleteExporter:
         """Wait for Logs API request to be processed"""
         logger.info(f"Waiting for request {request_id} to be processed...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
-
-        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}"
+        url = f"{self._counter_url}/logrequest/{request_id}"
 
         start_time = time.time()
         max_wait_seconds = max_wait_minutes * 60
 
+        # Poll quickly at first so small requests are picked up early, then back
+        # off exponentially (poll_delay)
+        attempts = 0
+
         status = 'created'
         while status in ('created', 'processing'):
             if time.time() - start_time > max_wait_seconds:
                 raise YandexMetricaAPIError(f"Request processing timeout after {max_wait_minutes} minutes")
 
-            time.sleep(10)  # Check every 10 seconds
+            time.sleep(poll_delay(attempts))
+            attempts += 1
 
             try:
-                response = requests.get(url, headers=header_dict, timeout=30)
+                response = self._session.get(url, timeout=30)
                 response.raise_for_status()
 
-                log_request = response.json()['log_request']
+                log_request = json_loads(response.content)['log_request']
                 status = log_request['status']
 
                 logger.info(f"Request status: {status}")
@@ -422,43 +499,222 @@ class YMCompleteExporter:
             except requests.RequestException as e:
                 raise YandexMetricaAPIError(f"Failed to check request status: {e}")
 
-    def download_data(self, request_id, parts, source):
-        """Download data from processed Logs API request"""
+    def download_and_upload(self, request_id, parts, source, upload, dtypes):
+        """
+        Download parts through pandas and upload each one as soon as it arrives.
+
+        Up to DOWNLOAD_WORKERS parts are downloaded in parallel while earlier
+        parts are being uploaded; no more than that many DataFrames are held
+        in memory at a time and they are never concatenated.
+
+        Args:
+            upload: callable taking a single part DataFrame
+            dtypes: API field -> dtype used to parse each part
+        """
         logger.info(f"Downloading {source} data from {len(parts)} parts...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
+        if not parts:
+            raise YandexMetricaAPIError("No data downloaded")
 
-        dataframes = []
+        total_rows = 0
+        pending = deque()
 
-        for part in parts:
-            part_num = part['part_number']
-            logger.info(f"  Downloading part {part_num}...")
+        def upload_next():
+            df = pending.popleft().result()
+            upload(df)
+            return len(df)
 
-            url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}/part/{part_num}/download"
+        with ThreadPoolExecutor(max_workers=self.DOWNLOAD_WORKERS) as executor:
+            for part in parts:
+                pending.append(executor.submit(self._download_part, request_id, part['part_number'], dtypes))
+                if len(pending) < self.DOWNLOAD_WORKERS:
+                    continue
 
-            try:
-                response = requests.get(url, headers=header_dict, timeout=300)
-                response.raise_for_status()
+                total_rows += upload_next()
+
+            while pending:
+                total_rows += upload_next()
 
-                df = pd.read_csv(StringIO(response.text), sep='\t')
-                dataframes.append(df)
-                logger.info(f"  ✓ Part {part_num} downloaded: {len(df)} rows")
+        logger.info(f"✓ Total rows uploaded for {source}: {total_rows}")
+        return total_rows
 
+    def _download_part(self, request_id, part_num, dtypes):
+        """Download a single Logs API part into a DataFrame with the given dtypes"""
+        logger.info(f"  Downloading part {part_num}...")
+
+        url = f"{self._counter_url}/logrequest/{request_id}/part/{part_num}/download"
+
+        try:
+            response = self._session.get(url, timeout=300)
+            response.raise_for_status()
+
+            if pacsv is not None:
+                # Arrow's multithreaded C++ parser, converted to pandas only at the end
+                table = pacsv.read_csv(
+                    BytesIO(response.content),
+                    parse_options=pacsv.ParseOptions(delimiter='\t'),
+                    convert_options=pacsv.ConvertOptions(column_types=dtypes)
+                )
+                df = table.to_pandas()
+            else:
+                df = pd.read_csv(
+                    BytesIO(response.content), sep='\t', encoding='utf-8',
+                    dtype=dtypes, keep_default_na=False
+                )
+            logger.info(f"  ✓ Part {part_num} downloaded: {len(df)} rows")
+            return df
+
+        except requests.RequestException as e:
+            raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
+        except Exception as e:
+            raise YandexMetricaAPIError(f"Failed to parse data from part {part_num}: {e}")
+
+    def download_and_upload_streaming(self, request_id, parts, source, table_name, header_rename):
+        """
+        Stream Logs API parts straight into ClickHouse without pandas.
+
+        Only the TSV header is rewritten (API field -> ClickHouse column);
+        the body is passed through unchanged as TSVWithNames, so the data
+        is never parsed or re-serialized on the client.
+        """
+        logger.info(f"Streaming {source} data from {len(parts)} parts into {table_name}...")
+
+        # Every part is an independent download and insert, so several of them
+        # run at once; each is its own INSERT, parts finish in any order
+        total_rows = 0
+        workers = max(1, min(self.STREAM_WORKERS, len(parts)))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    self._stream_part, request_id, part['part_number'], table_name, header_rename
+                ): part['part_number']
+                for part in parts
+            }
+            for future in as_completed(futures):
+                rows = future.result()
+                total_rows += rows
+                logger.info(f"  ✓ Part {futures[future]} uploaded: {rows} rows")
+
+        logger.info(f"✓ Total rows uploaded for {source}: {total_rows}")
+        return total_rows
+
+    def _stream_part(self, request_id, part_num, table_name, header_rename):
+        """Pipe a single Logs API part into ClickHouse and return its row count"""
+        logger.info(f"  Streaming part {part_num}...")
+
+        url = f"{self._counter_url}/logrequest/{request_id}/part/{part_num}/download"
+
+        rows = 0
+
+        def body(batch):
+            nonlocal rows
+            last = b'\n'
+            # The body is read from the download while it is being uploaded,
+            # so a download error is told apart from an upload one here
+            try:
+                for chunk in batch:
+                    rows += chunk.count(b'\n')
+                    last = chunk[-1:] or last
+                    yield chunk
             except requests.RequestException as e:
                 raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
-            except Exception as e:
-                raise YandexMetricaAPIError(f"Failed to parse data from part {part_num}: {e}")
+            # The header line of every batch is not a data row, a last row
+            # without a trailing newline is
+            rows -= 1 if last == b'\n' else 0
 
-        if not dataframes:
-            raise YandexMetricaAPIError("No data downloaded")
+        try:
+            with self._session.get(url, timeout=300, stream=True) as response:
+                response.raise_for_status()
+                chunks = self._rewrite_tsv_header(response.iter_content(chunk_size=1 << 20), header_rename)
+                for batch in self._split_tsv_batches(chunks, self._batch_size()):
+                    try:
+                        self.ch_client.upload(
+                            table_name, body(batch), data_format='TSVWithNames',
+                            settings=self._insert_settings(),
+                            compression=insert_compression(self.config)
+                        )
+                    except (requests.RequestException, ValueError) as e:
+                        raise ClickHouseError(f"Failed to upload part {part_num} to {table_name}: {e}")
+
+        except requests.RequestException as e:
+            raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
+
+        return max(rows, 0)
+
+    @staticmethod
+    def _rewrite_tsv_header(chunks, header_rename):
+        """
+        Yield TSV byte chunks with the header columns renamed via header_rename.
+
+        Rows are passed through untouched; a column without a mapping keeps
+        its API name and ClickHouse skips it (input_format_skip_unknown_fields).
+        """
+        chunks = iter(chunks)
+
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if b'\n' in head:
+                break
 
-        combined_df = pd.concat(dataframes, ignore_index=True)
-        logger.info(f"✓ Total rows downloaded for {source}: {len(combined_df)}")
+        header, newline, rest = head.partition(b'\n')
+        columns = header.decode('utf-8').split('\t')
+        yield '\t'.join(header_rename.get(column, column) for column in columns).encode('utf-8') + newline
 
-        return combined_df
+        if rest:
+            yield rest
+        yield from chunks
+
+    @staticmethod
+    def _split_tsv_batches(chunks, batch_rows):
+        """
+        Split a TSVWithNames byte stream into batches of at most batch_rows rows.
+
+        Yields one generator per batch; each starts with the header line and
+        must be consumed before the next one is requested, so the stream is
+        never buffered beyond the current chunk.
+        """
+        chunks = iter(chunks)
+
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if b'\n' in head:
+                break
+
+        header, newline, rest = head.partition(b'\n')
+        header += newline
+        state = {'rest': rest}
+
+        def batch():
+            yield header
+            rows = 0
+            while True:
+                chunk = state['rest'] or next(chunks, b'')
+                state['rest'] = b''
+                if not chunk:
+                    return
+
+                lines = chunk.count(b'\n')
+                if rows + lines < batch_rows:
+                    rows += lines
+                    yield chunk
+                    continue
+
+                # Cut right after the row that fills the batch
+                end = -1
+                for _ in range(batch_rows - rows):
+                    end = chunk.find(b'\n', end + 1)
+                yield chunk[:end + 1]
+                state['rest'] = chunk[end + 1:]
+                return
+
+        while True:
+            state['rest'] = state['rest'] or next(chunks, b'')
+            if not state['rest']:
+                return
+            yield batch()
 
     def create_hits_table(self, available_fields):
         """Create ClickHouse table for hits based on available fields"""
@@ -538,60 +794,119 @@ SETTINGS index_granularity=8192
         except Exception as e:
             raise ClickHouseError(f"Failed to create visits table: {e}")
 
-    def upload_hits_to_clickhouse(self, df, available_fields):
-        """Upload hits DataFrame to ClickHouse with explicit mapping"""
+    def upload_hits_to_clickhouse(self, df, projection):
+        """Upload hits DataFrame to ClickHouse with a precomputed column projection"""
         logger.info("Uploading hits data to ClickHouse...")
 
-        # Build rename mapping only for available fields
-        rename_mapping = {}
-        for api_field in available_fields:
-            if api_field in self.HITS_FIELD_MAPPING:
-                rename_mapping[api_field] = self.HITS_FIELD_MAPPING[api_field]
-
-        # Rename columns using explicit mapping
-        df_renamed = df.rename(columns=rename_mapping)
-
-        # Keep only the columns we need
-        columns_to_keep = [self.HITS_FIELD_MAPPING[f] for f in available_fields if f in self.HITS_FIELD_MAPPING]
-        df_renamed = df_renamed[columns_to_keep]
-
         table_name = f"{self.config['ch_database']}.hits_complete"
 
         try:
-            tsv_data = df_renamed.to_csv(sep='\t', index=False)
-            self.ch_client.upload(table_name, tsv_data)
+            self._upload_batches(table_name, df, projection)
             logger.info(f"✓ Successfully uploaded {len(df)} rows to {table_name}")
 
         except Exception as e:
             raise ClickHouseError(f"Failed to upload hits data to ClickHouse: {e}")
 
-    def upload_visits_to_clickhouse(self, df, available_fields):
-        """Upload visits DataFrame to ClickHouse with explicit mapping"""
+    def upload_visits_to_clickhouse(self, df, projection):
+        """Upload visits DataFrame to ClickHouse with a precomputed column projection"""
         logger.info("Uploading visits data to ClickHouse...")
 
-        # Build rename mapping only for available fields
-        rename_mapping = {}
-        for api_field in available_fields:
-            if api_field in self.VISITS_FIELD_MAPPING:
-                rename_mapping[api_field] = self.VISITS_FIELD_MAPPING[api_field]
-
-        # Rename columns using explicit mapping
-        df_renamed = df.rename(columns=rename_mapping)
-
-        # Keep only the columns we need
-        columns_to_keep = [self.VISITS_FIELD_MAPPING[f] for f in available_fields if f in self.VISITS_FIELD_MAPPING]
-        df_renamed = df_renamed[columns_to_keep]
-
         table_name = f"{self.config['ch_database']}.visits_complete"
 
         try:
-            tsv_data = df_renamed.to_csv(sep='\t', index=False)
-            self.ch_client.upload(table_name, tsv_data)
+            self._upload_batches(table_name, df, projection)
             logger.info(f"✓ Successfully uploaded {len(df)} rows to {table_name}")
 
         except Exception as e:
             raise ClickHouseError(f"Failed to upload visits data to ClickHouse: {e}")
 
+    def _batch_size(self):
+        """Rows per INSERT, from ch_batch_size"""
+        return max(1, int(self.config.get('ch_batch_size') or self.CH_BATCH_SIZE))
+
+    def _upload_batches(self, table_name, df, projection):
+        """Upload a DataFrame as one INSERT per ch_batch_size rows"""
+        batch_size = self._batch_size()
+        # max(..., 1) still sends an empty frame, so the table gets its header
+        for start in range(0, max(len(df), 1), batch_size):
+            batch = df.iloc[start:start + batch_size]
+            if pa is not None:
+                content, data_format = self._iter_arrow(batch, *projection), 'ArrowStream'
+            else:
+                content, data_format = self._iter_tsv(batch, *projection), 'TSVWithNames'
+            self.ch_client.upload(
+                table_name, content, data_format=data_format,
+                settings=self._insert_settings(),
+                compression=insert_compression(self.config)
+            )
+
+    def _insert_settings(self):
+        """
+        ClickHouse settings for an INSERT: async inserts when ch_async_insert is on.
+
+        Off by default, like in load_ym_to_clickhouse.py. Every insert waits
+        for the flush unless ch_async_insert_wait is false (errors in the
+        flush are then not reported back).
+        """
+        # Columns are matched by name, anything the table lacks is skipped
+        settings = {'input_format_skip_unknown_fields': 1}
+        if self.config.get('ch_async_insert'):
+            settings.update({
+                'async_insert': 1,
+                'wait_for_async_insert': 1 if self.config.get('ch_async_insert_wait', True) else 0,
+                'async_insert_busy_timeout_ms': 1000,
+                'async_insert_max_data_size': 10485760
+            })
+        return settings
+
+    def _parse_dtypes(self, available_fields, field_mapping, column_types):
+        """Map each available API field to the dtype matching its ClickHouse column"""
+        return {
+            field: self.PARSE_DTYPES.get(column_types[field_mapping[field]], 'str')
+            for field in available_fields if field in field_mapping
+        }
+
+    @staticmethod
+    def _column_projection(available_fields, field_mapping):
+        """
+        Precompute the column projection for an export.
+
+        Returns:
+            tuple: (API columns to write, ClickHouse names for their header)
+        """
+        columns = [field for field in available_fields if field in field_mapping]
+        return columns, [field_mapping[field] for field in columns]
+
+    def _iter_tsv(self, df, columns, header):
+        """
+        Serialize DataFrame columns as TSVWithNames in TSV_CHUNK_ROWS-row pieces.
+
+        The projection and rename are applied by to_csv itself (columns= and
+        header aliases), so no renamed or reindexed copy of the frame is made.
+        Yields UTF-8 bytes, so ClickHouse receives a chunked body and starts
+        parsing before serialization finishes.
+        """
+        buffer = BytesIO()
+        # max(..., 1) keeps the header for an empty frame
+        for start in range(0, max(len(df), 1), self.TSV_CHUNK_ROWS):
+            buffer.seek(0)
+            buffer.truncate()
+            df.iloc[start:start + self.TSV_CHUNK_ROWS].to_csv(
+                buffer, sep='\t', index=False, columns=columns,
+                header=header if start == 0 else False, encoding='utf-8'
+            )
+            yield buffer.getvalue()
+
+    def _iter_arrow(self, df, columns, header):
+        """
+        Serialize DataFrame columns as an Arrow IPC stream in TSV_CHUNK_ROWS-row batches.
+
+        Column buffers are handed to ClickHouse in binary form, so values are
+        never formatted as text; ClickHouse casts them to the column types.
+        """
+        table = pa.Table.from_pandas(df, columns=columns, preserve_index=False).rename_columns(header)
+        return iter_arrow_stream(table, self.TSV_CHUNK_ROWS)
+
     def export_hits(self):
         """Export hits data"""
         logger.info("\n" + "="*60)
@@ -618,14 +933,23 @@ SETTINGS index_granularity=8192
         # Wait for processing
         log_request = self.wait_for_request_processing(request_id)
 
-        # Download data
-        df = self.download_data(request_id, log_request['parts'], 'hits')
-
         # Create table
         self.create_hits_table(available_fields)
 
-        # Upload data
-        self.upload_hits_to_clickhouse(df, available_fields)
+        # Download and upload data
+        if self.config.get('stream_upload', True):
+            table_name = f"{self.config['ch_database']}.hits_complete"
+            self.download_and_upload_streaming(
+                request_id, log_request['parts'], 'hits', table_name, self.HITS_FIELD_MAPPING
+            )
+        else:
+            projection = self._column_projection(available_fields, self.HITS_FIELD_MAPPING)
+            dtypes = self._parse_dtypes(available_fields, self.HITS_FIELD_MAPPING, self.HITS_COLUMN_TYPES)
+            self.download_and_upload(
+                request_id, log_request['parts'], 'hits',
+                lambda df: self.upload_hits_to_clickhouse(df, projection),
+                dtypes
+            )
 
         logger.info("✓ Hits export completed successfully!\n")
 
@@ -655,14 +979,23 @@ SETTINGS index_granularity=8192
         # Wait for processing
         log_request = self.wait_for_request_processing(request_id)
 
-        # Download data
-        df = self.download_data(request_id, log_request['parts'], 'visits')
-
         # Create table
         self.create_visits_table(available_fields)
 
-        # Upload data
-        self.upload_visits_to_clickhouse(df, available_fields)
+        # Download and upload data
+        if self.config.get('stream_upload', True):
+            table_name = f"{self.config['ch_database']}.visits_complete"
+            self.download_and_upload_streaming(
+                request_id, log_request['parts'], 'visits', table_name, self.VISITS_FIELD_MAPPING
+            )
+        else:
+            projection = self._column_projection(available_fields, self.VISITS_FIELD_MAPPING)
+            dtypes = self._parse_dtypes(available_fields, self.VISITS_FIELD_MAPPING, self.VISITS_COLUMN_TYPES)
+            self.download_and_upload(
+                request_id, log_request['parts'], 'visits',
+                lambda df: self.upload_visits_to_clickhouse(df, projection),
+                dtypes
+            )
 
         logger.info("✓ Visits export completed successfully!\n")
 
@@ -713,8 +1046,8 @@ SETTINGS index_granularity=8192
 def load_config_from_file(config_path):
     """Load configuration from JSON file"""
     try:
-        with open(config_path, 'r') as f:
-            return json.load(f)
+        with open(config_path, 'rb') as f:
+            return json_loads(f.read())
     except FileNotFoundError:
         logger.error(f"Configuration file not found: {config_path}")
         sys.exit(1)
@@ -736,7 +1069,13 @@ def load_config_from_env():
         'ch_cacert': os.getenv('CH_CACERT', 'YandexInternalRootCA.crt'),
         'ch_database': os.getenv('CH_DATABASE', 'default'),
         'export_hits': os.getenv('EXPORT_HITS', 'true').lower() == 'true',
-        'export_visits': os.getenv('EXPORT_VISITS', 'true').lower() == 'true'
+        'export_visits': os.getenv('EXPORT_VISITS', 'true').lower() == 'true',
+        'stream_upload': os.getenv('STREAM_UPLOAD', 'true').lower() == 'true',
+        'ch_async_insert': os.getenv('CH_ASYNC_INSERT', 'false').lower() == 'true',
+        'ch_async_insert_wait': os.getenv('CH_ASYNC_INSERT_WAIT', 'true').lower() == 'true',
+        'ch_batch_size': int(os.getenv('CH_BATCH_SIZE', '100000')),
+        'ch_compression': os.getenv('CH_COMPRESSION'),
+        'cache_field_validation': os.getenv('CACHE_FIELD_VALIDATION', 'true').lower() == 'true'
     }
 
 
@@ -752,6 +1091,8 @@ Key features:
   - Proper field mapping (fixes clientID=0 issue in old script)
   - Graceful handling of unavailable fields
   - Detailed validation and logging
+  - Raw TSV streaming from Logs API to ClickHouse (set stream_upload=false
+    to go through pandas instead)
 
 Tables created:
   - hits_complete (8 fields)
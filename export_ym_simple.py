@@ -12,14 +12,29 @@ import time
 import json
 import logging
 import argparse
+import threading
 from datetime import datetime
 from urllib.parse import urlencode
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+import numpy as np
 import pandas as pd
 
-from some_funcs import simple_ch_client
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+except ImportError:
+    # pyarrow is optional, pandas parses and transforms the data without it
+    pa = None
+    pc = None
+    pacsv = None
+
+from some_funcs import (
+    simple_ch_client, FIELD_ERROR_RE, validate_fields_cached,
+    json_loads, poll_delay, ym_session, insert_compression, iter_arrow_stream
+)
 
 # Configure logging
 logging.basicConfig(
@@ -39,35 +54,89 @@ class ClickHouseError(Exception):
     pass
 
 
+# ClickHouse type -> Arrow type alias (pa.type_for_alias) used when parsing
+# parts. DateTime stays text: naive Arrow timestamps would be inserted as
+# UTC, while text is read in the ClickHouse server timezone
+ARROW_TYPES = {
+    'String': 'string',
+    'UInt64': 'uint64',
+    'Date': 'date32',
+    'DateTime': 'string'
+}
+
+
 class YMSimpleExporter:
     """Exports Yandex Metrica data to ClickHouse with only essential fields"""
 
-    # Fields from notebooks - HITS (8 fields)
-    HITS_FIELDS = (
-        'ym:pv:browser',
-        'ym:pv:clientID',
-        'ym:pv:date',
-        'ym:pv:dateTime',
-        'ym:pv:deviceCategory',
-        'ym:pv:lastTrafficSource',
-        'ym:pv:operatingSystemRoot',
-        'ym:pv:URL'
+    # Number of concurrent single-field evaluate probes
+    VALIDATION_WORKERS = 8
+
+    # Number of Logs API parts downloaded in parallel
+    DOWNLOAD_WORKERS = 8
+
+    # Rows per INSERT, bounds the memory spent on serializing an upload
+    UPLOAD_CHUNK_ROWS = 500_000
+
+    # Table layouts from notebooks: (API field, ClickHouse column, ClickHouse type).
+    # Field lists, renames, column lists, parse types and CREATE TABLE columns
+    # are all derived from these once, at class definition
+    HITS_SPEC = (
+        ('ym:pv:browser', 'Browser', 'String'),
+        ('ym:pv:clientID', 'ClientID', 'UInt64'),
+        ('ym:pv:date', 'EventDate', 'Date'),
+        ('ym:pv:dateTime', 'EventTime', 'DateTime'),
+        ('ym:pv:deviceCategory', 'DeviceCategory', 'String'),
+        ('ym:pv:lastTrafficSource', 'TraficSource', 'String'),
+        ('ym:pv:operatingSystemRoot', 'OSRoot', 'String'),
+        ('ym:pv:URL', 'URL', 'String')
     )
 
-    # Fields from notebooks - VISITS (10 fields)
-    VISITS_FIELDS = (
-        'ym:s:browser',
-        'ym:s:clientID',
-        'ym:s:date',
-        'ym:s:dateTime',
-        'ym:s:deviceCategory',
-        'ym:s:lastTrafficSource',
-        'ym:s:operatingSystemRoot',
-        'ym:s:purchaseID',
-        'ym:s:purchaseRevenue',
-        'ym:s:startURL'
+    # Purchases and Revenue have no API field, they are computed from purchaseRevenue
+    VISITS_SPEC = (
+        ('ym:s:browser', 'Browser', 'String'),
+        ('ym:s:clientID', 'ClientID', 'UInt64'),
+        ('ym:s:date', 'StartDate', 'Date'),
+        ('ym:s:dateTime', 'StartTime', 'DateTime'),
+        ('ym:s:deviceCategory', 'DeviceCategory', 'String'),
+        ('ym:s:lastTrafficSource', 'TraficSource', 'String'),
+        ('ym:s:operatingSystemRoot', 'OSRoot', 'String'),
+        (None, 'Purchases', 'Int32'),
+        (None, 'Revenue', 'Double'),
+        ('ym:s:startURL', 'StartURL', 'String')
     )
 
+    # Fetched for every visit but not stored as is
+    VISITS_PURCHASE_FIELDS = ('ym:s:purchaseID', 'ym:s:purchaseRevenue')
+
+    # Fields from notebooks - HITS (8 fields), VISITS (10 fields)
+    HITS_FIELDS = tuple(field for field, _, _ in HITS_SPEC)
+    VISITS_FIELDS = tuple(field for field, _, _ in VISITS_SPEC if field) + VISITS_PURCHASE_FIELDS
+
+    # Field lists as sent to create_logs_request, sorted case-insensitively
+    HITS_FIELDS_SORTED_CSV = ','.join(sorted(HITS_FIELDS, key=str.lower))
+    VISITS_FIELDS_SORTED_CSV = ','.join(sorted(VISITS_FIELDS, key=str.lower))
+    _HITS_FIELD_SET = frozenset(HITS_FIELDS)
+    _VISITS_FIELD_SET = frozenset(VISITS_FIELDS)
+
+    # API field -> ClickHouse column
+    HITS_FIELD_MAPPING = {field: column for field, column, _ in HITS_SPEC}
+    VISITS_FIELD_MAPPING = {field: column for field, column, _ in VISITS_SPEC if field}
+
+    # Columns of the tables, in table order
+    HITS_COLUMNS = [column for _, column, _ in HITS_SPEC]
+    VISITS_COLUMNS = [column for _, column, _ in VISITS_SPEC]
+
+    # Column definitions for CREATE TABLE
+    HITS_DDL = ',\n            '.join(f'{column} {ch_type}' for _, column, ch_type in HITS_SPEC)
+    VISITS_DDL = ',\n            '.join(f'{column} {ch_type}' for _, column, ch_type in VISITS_SPEC)
+
+    # API field -> Arrow type alias for parsing parts, so the CSV reader does
+    # no type inference
+    FIELD_TYPES = {
+        **{field: ARROW_TYPES[ch_type] for field, _, ch_type in HITS_SPEC + VISITS_SPEC if field},
+        **{field: 'string' for field in VISITS_PURCHASE_FIELDS}
+    }
+
     def __init__(self, config):
         """
         Initialize exporter with configuration
@@ -89,6 +158,9 @@ class YMSimpleExporter:
         self.config = config
         self.api_host = 'https://api-metrika.yandex.ru'
         self.ch_client = None
+        self._session = ym_session(config.get('ym_token'), pool_connections=4)
+        # Set when one of the concurrent exports fails, so the other one stops
+        self._stop = threading.Event()
 
     def validate_config(self):
         """Validate required configuration parameters"""
@@ -139,20 +211,21 @@ class YMSimpleExporter:
         """
         Validate that all specified fields are available for the counter.
 
-        Args:
-            source: 'hits' or 'visits'
-            fields: tuple of field names
-
         Returns:
             tuple: (available_fields, unavailable_fields)
         """
-        logger.info(f"Validating {len(fields)} fields for {source}...")
+        return validate_fields_cached(self.config, source, fields, self._probe_fields)
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
+    def _probe_fields(self, source, fields):
+        """
+        Validate fields against the evaluate endpoint.
 
+        Returns:
+            tuple: (available_fields, unavailable_fields, conclusive), where
+            conclusive is False unless every unavailable field was refused
+            by the API with an error naming it (and at least one was, once
+            the all-fields probe failed)
+        """
         # Test all fields together
         url_params = urlencode([
             ('date1', self.config['start_date']),
@@ -164,18 +237,21 @@ class YMSimpleExporter:
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
 
         try:
-            response = requests.get(url, headers=header_dict, timeout=30)
+            response = self._session.get(url, timeout=30)
 
             if response.status_code == 200:
-                result = response.json().get('log_request_evaluation', {})
+                result = json_loads(response.content).get('log_request_evaluation', {})
                 if result.get('possible', False):
                     logger.info(f"✓ All {len(fields)} fields are available for {source}")
-                    return list(fields), []
+                    return list(fields), [], True
                 else:
                     raise YandexMetricaAPIError(f"Cannot create log request for {source}")
             else:
                 # Some fields might not be available
-                error_data = response.json() if response.status_code == 400 else {}
+                try:
+                    error_data = json_loads(response.content) if response.status_code == 400 else {}
+                except ValueError:
+                    error_data = {}
                 error_message = error_data.get('message', response.text)
 
                 logger.warning(f"Field validation failed for {source}: {error_message}")
@@ -183,68 +259,94 @@ class YMSimpleExporter:
                 # Try to identify problematic fields by testing individually
                 available = []
                 unavailable = []
+                outcomes = []
 
                 logger.info(f"Testing fields individually for {source}...")
-                for field in fields:
-                    url_params = urlencode([
-                        ('date1', self.config['start_date']),
-                        ('date2', self.config['end_date']),
-                        ('source', source),
-                        ('fields', field)
-                    ])
-
-                    url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
-                    response = requests.get(url, headers=header_dict, timeout=10)
-
-                    if response.status_code == 200:
-                        result = response.json().get('log_request_evaluation', {})
-                        if result.get('possible', False):
+                workers = min(self.VALIDATION_WORKERS, len(fields))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = executor.map(lambda field: self._probe_field(source, field), fields)
+
+                    for field, outcome in results:
+                        if outcome == 'possible':
                             available.append(field)
                             logger.info(f"  ✓ {field}")
                         else:
                             unavailable.append(field)
-                            logger.warning(f"  ✗ {field} - not possible")
-                    else:
-                        unavailable.append(field)
-                        logger.warning(f"  ✗ {field} - error")
+                            outcomes.append(outcome)
+                            logger.warning(f"  ✗ {field} - {outcome}")
 
-                return available, unavailable
+                # With no field to blame, the bulk failure is unexplained
+                conclusive = bool(outcomes) and all(outcome == 'refused' for outcome in outcomes)
+                return available, unavailable, conclusive
 
         except requests.RequestException as e:
             raise YandexMetricaAPIError(f"Failed to validate fields: {e}")
 
+    def _probe_field(self, source, field):
+        """
+        Evaluate a single field.
+
+        Returns:
+            tuple: (field, outcome), outcome being 'possible', 'not possible',
+            'refused' (an error naming the field) or 'error'
+        """
+        url_params = urlencode([
+            ('date1', self.config['start_date']),
+            ('date2', self.config['end_date']),
+            ('source', source),
+            ('fields', field)
+        ])
+
+        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
+        response = self._session.get(url, timeout=10)
+
+        if response.status_code != 200:
+            # Not JSON (ValueError) or not a JSON object (AttributeError)
+            try:
+                message = json_loads(response.content).get('message', '') if response.status_code == 400 else ''
+            except (ValueError, AttributeError):
+                message = ''
+            return field, 'refused' if field in FIELD_ERROR_RE.findall(message) else 'error'
+
+        result = json_loads(response.content).get('log_request_evaluation', {})
+        return field, 'possible' if result.get('possible', False) else 'not possible'
+
+    def _sorted_fields_csv(self, fields):
+        """Comma-joined fields sorted case-insensitively; precomputed for the full field sets"""
+        fields = frozenset(fields)
+        if fields == self._HITS_FIELD_SET:
+            return self.HITS_FIELDS_SORTED_CSV
+        if fields == self._VISITS_FIELD_SET:
+            return self.VISITS_FIELDS_SORTED_CSV
+        return ','.join(sorted(fields, key=str.lower))
+
     def create_logs_request(self, source, fields):
         """Create Logs API request and return request_id"""
         logger.info(f"Creating Logs API request for {source}...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
-
         url_params = urlencode([
             ('date1', self.config['start_date']),
             ('date2', self.config['end_date']),
             ('source', source),
-            ('fields', ','.join(sorted(fields, key=lambda s: s.lower())))
+            ('fields', self._sorted_fields_csv(fields))
         ])
 
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests?{url_params}"
 
         try:
-            response = requests.post(url, headers=header_dict, timeout=30)
+            response = self._session.post(url, timeout=30)
 
             if response.status_code != 200:
                 error_msg = f"API returned status {response.status_code}"
                 try:
-                    error_data = response.json()
+                    error_data = json_loads(response.content)
                     if 'message' in error_data:
                         error_msg += f": {error_data['message']}"
                 except:
                     error_msg += f". Response: {response.text[:200]}"
                 raise YandexMetricaAPIError(error_msg)
 
-            request_id = response.json()['log_request']['request_id']
+            request_id = json_loads(response.content)['log_request']['request_id']
             logger.info(f"✓ Logs API request created for {source} with ID: {request_id}")
             return request_id
 
@@ -255,28 +357,30 @@ class YMSimpleExporter:
         """Wait for Logs API request to be processed"""
         logger.info(f"Waiting for request {request_id} to be processed...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
-
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}"
 
         start_time = time.time()
         max_wait_seconds = max_wait_minutes * 60
 
+        # Poll quickly at first so small requests are picked up early, then back
+        # off exponentially (poll_delay). A 429 response is retried by the
+        # session adapter, honoring Retry-After
+        attempts = 0
+
         status = 'created'
         while status in ('created', 'processing'):
             if time.time() - start_time > max_wait_seconds:
                 raise YandexMetricaAPIError(f"Request processing timeout after {max_wait_minutes} minutes")
 
-            time.sleep(10)  # Check every 10 seconds
+            if self._stop.wait(poll_delay(attempts)):
+                raise YandexMetricaAPIError("Export stopped")
+            attempts += 1
 
             try:
-                response = requests.get(url, headers=header_dict, timeout=30)
+                response = self._session.get(url, timeout=30)
                 response.raise_for_status()
 
-                log_request = response.json()['log_request']
+                log_request = json_loads(response.content)['log_request']
                 status = log_request['status']
 
                 logger.info(f"Request status: {status}")
@@ -290,43 +394,154 @@ class YMSimpleExporter:
             except requests.RequestException as e:
                 raise YandexMetricaAPIError(f"Failed to check request status: {e}")
 
-    def download_data(self, request_id, parts, source):
-        """Download data from processed Logs API request"""
+    def download_and_upload(self, request_id, parts, source, upload):
+        """
+        Download parts in parallel, uploading each while it is being read.
+
+        Every worker parses its part incrementally and hands pieces of about
+        UPLOAD_CHUNK_ROWS rows to upload as they are read, so downloads and
+        inserts overlap and memory is bounded by one piece per worker rather
+        than by part size. Parts are never concatenated.
+
+        Args:
+            upload: callable taking a piece of a part (Arrow table, or DataFrame without pyarrow)
+        """
         logger.info(f"Downloading {source} data from {len(parts)} parts...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
+        if not parts:
+            raise YandexMetricaAPIError("No data downloaded")
 
-        dataframes = []
+        workers = min(self.DOWNLOAD_WORKERS, len(parts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            total_rows = sum(executor.map(
+                lambda part: self._download_part(request_id, part['part_number'], upload),
+                parts
+            ))
 
-        for part in parts:
-            part_num = part['part_number']
-            logger.info(f"  Downloading part {part_num}...")
+        logger.info(f"✓ Total rows uploaded for {source}: {total_rows}")
+        return total_rows
 
-            url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}/part/{part_num}/download"
+    def _download_part(self, request_id, part_num, upload):
+        """Stream a single Logs API part into upload piece by piece; returns its row count"""
+        logger.info(f"  Downloading part {part_num}...")
 
-            try:
-                response = requests.get(url, headers=header_dict, timeout=300)
+        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}/part/{part_num}/download"
+
+        rows = 0
+        try:
+            with self._session.get(url, timeout=300, stream=True) as response:
                 response.raise_for_status()
+                # Parse straight from the socket; gzip is inflated on the fly
+                response.raw.decode_content = True
+                for piece in self._read_part(response.raw):
+                    if self._stop.is_set():
+                        raise YandexMetricaAPIError("Export stopped")
+                    upload(piece)
+                    rows += len(piece)
 
-                df = pd.read_csv(StringIO(response.text), sep='\t')
-                dataframes.append(df)
-                logger.info(f"  ✓ Part {part_num} downloaded: {len(df)} rows")
+            logger.info(f"  ✓ Part {part_num} uploaded: {rows} rows")
+            return rows
 
-            except requests.RequestException as e:
-                raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
-            except Exception as e:
-                raise YandexMetricaAPIError(f"Failed to parse data from part {part_num}: {e}")
+        except requests.RequestException as e:
+            raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
+        except (ClickHouseError, YandexMetricaAPIError):
+            raise
+        except Exception as e:
+            raise YandexMetricaAPIError(f"Failed to parse data from part {part_num}: {e}")
 
-        if not dataframes:
-            raise YandexMetricaAPIError("No data downloaded")
+    def _upload(self, table_name, data):
+        """
+        Insert a part into ClickHouse, one INSERT per UPLOAD_CHUNK_ROWS rows.
+
+        An Arrow table is sent as a binary Arrow IPC stream, so no text
+        serialization happens on the client; a DataFrame (no pyarrow) goes
+        as TSV. Bodies are compressed and streamed, so only one chunk is
+        serialized at a time and no full compressed copy is built.
+        """
+        compression = insert_compression(self.config)
+        total = len(data)
+        for start in range(0, max(total, 1), self.UPLOAD_CHUNK_ROWS):
+            if pa is None:
+                chunk = data.iloc[start:start + self.UPLOAD_CHUNK_ROWS]
+                self.ch_client.upload(table_name, chunk.to_csv(sep='\t', index=False), compression=compression)
+            else:
+                chunk = data.slice(start, self.UPLOAD_CHUNK_ROWS)
+                self.ch_client.upload(
+                    table_name, iter_arrow_stream(chunk),
+                    data_format='ArrowStream', compression=compression
+                )
+
+            logger.info(f"  Uploaded {min(start + self.UPLOAD_CHUNK_ROWS, total)}/{total} rows to {table_name}")
+
+    @staticmethod
+    def _purchase_stats(revenue):
+        """
+        Purchases and Revenue from ym:s:purchaseRevenue values (as in notebook):
+        '[1.5,2]' -> 2 purchases, 3.5 revenue; '[]' -> 0 and 0.
+
+        Works on an Arrow array with pyarrow.compute, otherwise on a pandas
+        Series with vectorized string methods.
+        """
+        if pa is None:
+            items = revenue[revenue.ne('[]')].str.slice(1, -1)
+            purchases = (items.str.count(',') + 1).reindex(revenue.index, fill_value=0).astype('int64')
+            revenue_sum = (
+                items.str.split(',').explode().astype('float64')
+                .groupby(level=0).sum()
+                .reindex(revenue.index, fill_value=0.0)
+            )
+            return purchases, revenue_sum
+
+        revenue = revenue.combine_chunks()
+        empty = pc.equal(revenue, '[]')
+        items = pc.if_else(empty, pa.scalar(None, pa.string()), pc.utf8_slice_codeunits(revenue, 1, -1))
+        purchases = pc.if_else(empty, 0, pc.add(pc.count_substring(items, ','), 1))
+
+        # Sum each row's values by scattering the flattened list onto its row
+        lists = pc.split_pattern(items, ',')
+        values = pc.cast(pc.list_flatten(lists), pa.float64()).to_numpy()
+        rows = pc.list_parent_indices(lists).to_numpy()
+        revenue_sum = pa.array(np.bincount(rows, weights=values, minlength=len(revenue)))
+        return purchases, revenue_sum
+
+    @classmethod
+    def _read_part(cls, stream):
+        """
+        Parse a TSV part from a file-like stream incrementally.
+
+        Yields Arrow tables of at least UPLOAD_CHUNK_ROWS rows (the last one
+        may be smaller) built from the reader's record batches, or DataFrame
+        chunks without pyarrow; only one piece is in memory at a time.
+        """
+        if pacsv is None:
+            dtypes = {field: 'uint64' if alias == 'uint64' else 'str' for field, alias in cls.FIELD_TYPES.items()}
+            yield from pd.read_csv(
+                stream, sep='\t', encoding='utf-8', dtype=dtypes,
+                keep_default_na=False, chunksize=cls.UPLOAD_CHUNK_ROWS
+            )
+            return
+
+        reader = pacsv.open_csv(
+            stream,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=8 << 20),
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(
+                column_types={field: pa.type_for_alias(alias) for field, alias in cls.FIELD_TYPES.items()}
+            )
+        )
 
-        combined_df = pd.concat(dataframes, ignore_index=True)
-        logger.info(f"✓ Total rows downloaded for {source}: {len(combined_df)}")
+        batches = []
+        rows = 0
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= cls.UPLOAD_CHUNK_ROWS:
+                yield pa.Table.from_batches(batches, schema=reader.schema)
+                batches = []
+                rows = 0
 
-        return combined_df
+        if rows:
+            yield pa.Table.from_batches(batches, schema=reader.schema)
 
     def create_hits_table(self):
         """Create ClickHouse table for hits"""
@@ -340,14 +555,7 @@ class YMSimpleExporter:
         # Create table matching notebook schema
         create_query = f"""
         CREATE TABLE {table_name} (
-            Browser String,
-            ClientID UInt64,
-            EventDate Date,
-            EventTime DateTime,
-            DeviceCategory String,
-            TraficSource String,
-            OSRoot String,
-            URL String
+            {self.HITS_DDL}
         ) ENGINE = MergeTree()
         ORDER BY (intHash32(ClientID), EventDate)
         SAMPLE BY intHash32(ClientID)
@@ -376,16 +584,7 @@ class YMSimpleExporter:
         # Create table matching notebook schema
         create_query = f"""
         CREATE TABLE {table_name} (
-            Browser String,
-            ClientID UInt64,
-            StartDate Date,
-            StartTime DateTime,
-            DeviceCategory String,
-            TraficSource String,
-            OSRoot String,
-            Purchases Int32,
-            Revenue Double,
-            StartURL String
+            {self.VISITS_DDL}
         ) ENGINE = MergeTree()
         ORDER BY (intHash32(ClientID), StartDate)
         SAMPLE BY intHash32(ClientID)
@@ -402,69 +601,53 @@ class YMSimpleExporter:
         except Exception as e:
             raise ClickHouseError(f"Failed to create visits table: {e}")
 
-    def upload_hits_to_clickhouse(self, df):
-        """Upload hits DataFrame to ClickHouse"""
+    def upload_hits_to_clickhouse(self, data):
+        """Upload a hits part (Arrow table or DataFrame) to ClickHouse"""
         logger.info("Uploading hits data to ClickHouse...")
 
         # Rename columns to match table schema (as in notebook)
-        df_renamed = df.rename(columns={
-            'ym:pv:browser': 'Browser',
-            'ym:pv:clientID': 'ClientID',
-            'ym:pv:date': 'EventDate',
-            'ym:pv:dateTime': 'EventTime',
-            'ym:pv:deviceCategory': 'DeviceCategory',
-            'ym:pv:lastTrafficSource': 'TraficSource',
-            'ym:pv:operatingSystemRoot': 'OSRoot',
-            'ym:pv:URL': 'URL'
-        })
+        if pa is not None:
+            # Metadata only, no data is copied
+            renamed = data.rename_columns([self.HITS_FIELD_MAPPING.get(c, c) for c in data.column_names])
+        else:
+            renamed = data.rename(columns=self.HITS_FIELD_MAPPING)
 
         table_name = f"{self.config['ch_database']}.hits_simple"
 
         try:
-            tsv_data = df_renamed.to_csv(sep='\t', index=False)
-            self.ch_client.upload(table_name, tsv_data)
-            logger.info(f"✓ Successfully uploaded {len(df)} rows to {table_name}")
+            self._upload(table_name, renamed)
+            logger.info(f"✓ Successfully uploaded {len(data)} rows to {table_name}")
 
         except Exception as e:
             raise ClickHouseError(f"Failed to upload hits data to ClickHouse: {e}")
 
-    def upload_visits_to_clickhouse(self, df):
-        """Upload visits DataFrame to ClickHouse"""
+    def upload_visits_to_clickhouse(self, data):
+        """Upload a visits part (Arrow table or DataFrame) to ClickHouse"""
         logger.info("Uploading visits data to ClickHouse...")
 
-        # Rename columns to match table schema (as in notebook)
-        df_renamed = df.rename(columns={
-            'ym:s:browser': 'Browser',
-            'ym:s:clientID': 'ClientID',
-            'ym:s:date': 'StartDate',
-            'ym:s:dateTime': 'StartTime',
-            'ym:s:deviceCategory': 'DeviceCategory',
-            'ym:s:lastTrafficSource': 'TraficSource',
-            'ym:s:operatingSystemRoot': 'OSRoot',
-            'ym:s:startURL': 'StartURL'
-        })
-
         # Process purchase data (as in notebook)
-        df_renamed['Purchases'] = df['ym:s:purchaseRevenue'].map(
-            lambda x: x.count(',') + 1 if x != '[]' else 0
-        )
-        df_renamed['Revenue'] = df['ym:s:purchaseRevenue'].map(
-            lambda x: sum(map(float, x[1:-1].split(','))) if x != '[]' else 0
-        )
-
-        # Keep only the columns we need
-        df_renamed = df_renamed[[
-            'Browser', 'ClientID', 'StartDate', 'StartTime',
-            'DeviceCategory', 'TraficSource', 'OSRoot',
-            'Purchases', 'Revenue', 'StartURL'
-        ]]
+        purchases, revenue = self._purchase_stats(data['ym:s:purchaseRevenue'])
+
+        # Rename columns to match table schema and keep only the ones we need;
+        # for Arrow all of it is metadata only
+        if pa is not None:
+            renamed = (
+                data.rename_columns([self.VISITS_FIELD_MAPPING.get(c, c) for c in data.column_names])
+                .append_column('Purchases', purchases)
+                .append_column('Revenue', revenue)
+                .select(self.VISITS_COLUMNS)
+            )
+        else:
+            renamed = data.rename(columns=self.VISITS_FIELD_MAPPING)
+            renamed['Purchases'] = purchases
+            renamed['Revenue'] = revenue
+            renamed = renamed[self.VISITS_COLUMNS]
 
         table_name = f"{self.config['ch_database']}.visits_simple"
 
         try:
-            tsv_data = df_renamed.to_csv(sep='\t', index=False)
-            self.ch_client.upload(table_name, tsv_data)
-            logger.info(f"✓ Successfully uploaded {len(df)} rows to {table_name}")
+            self._upload(table_name, renamed)
+            logger.info(f"✓ Successfully uploaded {len(data)} rows to {table_name}")
 
         except Exception as e:
             raise ClickHouseError(f"Failed to upload visits data to ClickHouse: {e}")
@@ -491,14 +674,11 @@ class YMSimpleExporter:
         # Wait for processing
         log_request = self.wait_for_request_processing(request_id)
 
-        # Download data
-        df = self.download_data(request_id, log_request['parts'], 'hits')
-
         # Create table
         self.create_hits_table()
 
-        # Upload data
-        self.upload_hits_to_clickhouse(df)
+        # Download data and upload it part by part
+        self.download_and_upload(request_id, log_request['parts'], 'hits', self.upload_hits_to_clickhouse)
 
         logger.info("✓ Hits export completed successfully!\n")
 
@@ -524,14 +704,11 @@ class YMSimpleExporter:
         # Wait for processing
         log_request = self.wait_for_request_processing(request_id)
 
-        # Download data
-        df = self.download_data(request_id, log_request['parts'], 'visits')
-
         # Create table
         self.create_visits_table()
 
-        # Upload data
-        self.upload_visits_to_clickhouse(df)
+        # Download data and upload it part by part
+        self.download_and_upload(request_id, log_request['parts'], 'visits', self.upload_visits_to_clickhouse)
 
         logger.info("✓ Visits export completed successfully!\n")
 
@@ -548,18 +725,33 @@ class YMSimpleExporter:
             # Initialize ClickHouse client
             self.init_clickhouse_client()
 
+            exports = []
+
             # Export hits if enabled
             if self.config.get('export_hits', True):
-                self.export_hits()
+                exports.append(self.export_hits)
             else:
                 logger.info("Skipping hits export (disabled)")
 
             # Export visits if enabled
             if self.config.get('export_visits', True):
-                self.export_visits()
+                exports.append(self.export_visits)
             else:
                 logger.info("Skipping visits export (disabled)")
 
+            # Hits and visits are independent Logs API requests and tables, so
+            # their waits, downloads and inserts overlap instead of adding up.
+            # The first failure is reported as soon as it happens; the other
+            # export then stops at its next status poll or part piece
+            with ThreadPoolExecutor(max_workers=max(1, len(exports))) as executor:
+                futures = [executor.submit(export) for export in exports]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    self._stop.set()
+                    raise
+
             logger.info("="*60)
             logger.info("ALL EXPORTS COMPLETED SUCCESSFULLY!")
             logger.info("="*60)
@@ -582,8 +774,8 @@ class YMSimpleExporter:
 def load_config_from_file(config_path):
     """Load configuration from JSON file"""
     try:
-        with open(config_path, 'r') as f:
-            return json.load(f)
+        with open(config_path, 'rb') as f:
+            return json_loads(f.read())
     except FileNotFoundError:
         logger.error(f"Configuration file not found: {config_path}")
         sys.exit(1)
@@ -605,7 +797,9 @@ def load_config_from_env():
         'ch_cacert': os.getenv('CH_CACERT', 'YandexInternalRootCA.crt'),
         'ch_database': os.getenv('CH_DATABASE', 'default'),
         'export_hits': os.getenv('EXPORT_HITS', 'true').lower() == 'true',
-        'export_visits': os.getenv('EXPORT_VISITS', 'true').lower() == 'true'
+        'export_visits': os.getenv('EXPORT_VISITS', 'true').lower() == 'true',
+        'cache_field_validation': os.getenv('CACHE_FIELD_VALIDATION', 'true').lower() == 'true',
+        'ch_compression': os.getenv('CH_COMPRESSION')
     }
 
 
@@ -665,6 +859,12 @@ Examples:
         help='Export only visits data'
     )
 
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Revalidate fields instead of using cached results'
+    )
+
     args = parser.parse_args()
 
     # Load configuration
@@ -681,6 +881,9 @@ Examples:
         config['export_hits'] = False
         config['export_visits'] = True
 
+    if args.no_cache:
+        config['cache_field_validation'] = False
+
     # Create exporter and run
     exporter = YMSimpleExporter(config)
     success = exporter.run()
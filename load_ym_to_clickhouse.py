@@ -6,19 +6,39 @@ Supports configuration via config file or environment variables.
 """
 
 import os
+import mmap
 import sys
 import time
+import uuid
 import json
+import queue
+import shutil
 import logging
+import tempfile
+import threading
 import argparse
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import numpy as np
 import pandas as pd
 
-from some_funcs import simple_ch_client
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+except ImportError:
+    # pyarrow is optional, pandas parses the data and it is uploaded as TSV without it
+    pa = None
+    pc = None
+    pacsv = None
+
+from some_funcs import (
+    simple_ch_client, ClickHouseHTTPError, FIELD_ERROR_RE, json_loads, poll_delay, ym_session,
+    insert_compression, iter_arrow_stream
+)
 
 # Configure logging
 logging.basicConfig(
@@ -27,6 +47,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ClickHouse type -> pandas dtype for parsing parts; other types are read as str
+PANDAS_TYPES = {
+    'UInt64': 'uint64',
+    'UInt32': 'uint32',
+    'UInt8': 'uint8',
+}
+
+# ClickHouse type -> Arrow type for ArrowStream inserts. DateTime values stay
+# strings, so the server parses them in its own time zone just like from TSV
+ARROW_TYPES = {
+    'UInt64': pa.uint64(),
+    'UInt32': pa.uint32(),
+    'UInt8': pa.uint8(),
+    'Date': pa.date32(),
+    'String': pa.large_string(),
+    'Array(DateTime)': pa.list_(pa.large_string()),
+    'Array(Decimal(18,4))': pa.list_(pa.decimal128(18, 4)),
+    'Array(UInt32)': pa.list_(pa.uint32()),
+} if pa is not None else {}
+
+# Low-cardinality fields parsed as categorical (dictionary-encoded with pyarrow)
+CATEGORICAL_FIELDS = {
+    'ym:s:deviceCategory',
+    'ym:s:operatingSystemRoot',
+    'ym:s:UTMMedium',
+    'ym:s:TrafficSource',
+    'ym:s:purchaseCurrency',
+    'ym:s:regionCity',
+    'ym:s:AdvEngine',
+    'ym:s:SearchEngineRoot',
+}
+
 
 class YandexMetricaAPIError(Exception):
     """Custom exception for Yandex Metrica API errors"""
@@ -41,49 +93,101 @@ class ClickHouseError(Exception):
 class YMToClickHouseLoader:
     """Loads Yandex Metrica visits data to ClickHouse"""
 
-    # Fields to extract from Yandex Metrica API (visits)
+    # Fields to extract from Yandex Metrica API (visits): API field ->
+    # (ClickHouse column, ClickHouse type). API_FIELDS and the dtypes and
+    # schema below are derived from it, so they never get out of sync.
+    # Array fields come from the API as [a,b,...] literals, which is also
+    # ClickHouse's TSV array syntax, so they load without a transform.
     # Note: Some advertising fields like DirectPlatform and DirectConditionType
     # are not available for all counters and have been removed
-    API_FIELDS = (
-        'ym:s:visitID',
-        'ym:s:watchIDs',
-        'ym:s:date',
-        'ym:s:isNewUser',
-        'ym:s:startURL',
-        'ym:s:endURL',
-        'ym:s:visitDuration',
-        'ym:s:bounce',
-        'ym:s:clientID',
-        'ym:s:goalsID',
-        'ym:s:goalsDateTime',
-        'ym:s:referer',
-        'ym:s:deviceCategory',
-        'ym:s:operatingSystemRoot',
-        'ym:s:UTMCampaign',
-        'ym:s:UTMContent',
-        'ym:s:UTMMedium',
-        'ym:s:UTMSource',
-        'ym:s:UTMTerm',
-        'ym:s:TrafficSource',
-        'ym:s:pageViews',
-        'ym:s:purchaseID',
-        'ym:s:purchaseDateTime',
-        'ym:s:purchaseRevenue',
-        'ym:s:purchaseCurrency',
-        'ym:s:purchaseProductQuantity',
-        'ym:s:productsPurchaseID',
-        'ym:s:productsID',
-        'ym:s:productsName',
-        'ym:s:productsCategory',
-        'ym:s:regionCity',
-        'ym:s:impressionsURL',
-        'ym:s:impressionsDateTime',
-        'ym:s:impressionsProductID',
-        'ym:s:AdvEngine',
-        'ym:s:ReferalSource',
-        'ym:s:SearchEngineRoot',
-        'ym:s:SearchPhrase'
-    )
+    _FIELD_TYPES = {
+        'ym:s:visitID': ('visitID', 'UInt64'),
+        'ym:s:watchIDs': ('watchIDs', 'String'),
+        'ym:s:date': ('date', 'Date'),
+        'ym:s:isNewUser': ('isNewUser', 'UInt8'),
+        'ym:s:startURL': ('startURL', 'String'),
+        'ym:s:endURL': ('endURL', 'String'),
+        'ym:s:visitDuration': ('visitDuration', 'UInt32'),
+        'ym:s:bounce': ('bounce', 'UInt8'),
+        'ym:s:clientID': ('clientID', 'UInt64'),
+        'ym:s:goalsID': ('goalsID', 'String'),
+        'ym:s:goalsDateTime': ('goalsDateTime', 'Array(DateTime) CODEC(Delta, ZSTD(3))'),
+        'ym:s:referer': ('referer', 'String'),
+        'ym:s:deviceCategory': ('deviceCategory', 'String'),
+        'ym:s:operatingSystemRoot': ('operatingSystemRoot', 'String'),
+        'ym:s:UTMCampaign': ('UTMCampaign', 'String'),
+        'ym:s:UTMContent': ('UTMContent', 'String'),
+        'ym:s:UTMMedium': ('UTMMedium', 'String'),
+        'ym:s:UTMSource': ('UTMSource', 'String'),
+        'ym:s:UTMTerm': ('UTMTerm', 'String'),
+        'ym:s:TrafficSource': ('TrafficSource', 'String'),
+        'ym:s:pageViews': ('pageViews', 'UInt32'),
+        'ym:s:purchaseID': ('purchaseID', 'String'),
+        'ym:s:purchaseDateTime': ('purchaseDateTime', 'Array(DateTime) CODEC(Delta, ZSTD(3))'),
+        'ym:s:purchaseRevenue': ('purchaseRevenue', 'Array(Decimal(18,4))'),
+        'ym:s:purchaseCurrency': ('purchaseCurrency', 'String'),
+        'ym:s:purchaseProductQuantity': ('purchaseProductQuantity', 'Array(UInt32)'),
+        'ym:s:productsPurchaseID': ('productsPurchaseID', 'String'),
+        'ym:s:productsID': ('productsID', 'String'),
+        'ym:s:productsName': ('productsName', 'String'),
+        'ym:s:productsCategory': ('productsCategory', 'String'),
+        'ym:s:regionCity': ('regionCity', 'String'),
+        'ym:s:impressionsURL': ('impressionsURL', 'String'),
+        'ym:s:impressionsDateTime': ('impressionsDateTime', 'Array(DateTime) CODEC(Delta, ZSTD(3))'),
+        'ym:s:impressionsProductID': ('impressionsProductID', 'String'),
+        'ym:s:AdvEngine': ('AdvEngine', 'String'),
+        'ym:s:ReferalSource': ('ReferalSource', 'String'),
+        'ym:s:SearchEngineRoot': ('SearchEngineRoot', 'String'),
+        'ym:s:SearchPhrase': ('SearchPhrase', 'String')
+    }
+
+    API_FIELDS = tuple(_FIELD_TYPES)
+
+    # Field lists as sent to the API: as is for evaluate, sorted
+    # case-insensitively for the log request itself
+    _FIELDS_CSV = ','.join(API_FIELDS)
+    _FIELDS_CSV_SORTED = ','.join(sorted(API_FIELDS, key=str.lower))
+
+    # Column dtypes for parsing Logs API parts with pandas, so it doesn't infer
+    # each column (as object) on every part; Date fields are parsed as dates
+    _PANDAS_DTYPES = {
+        field: 'category' if field in CATEGORICAL_FIELDS else PANDAS_TYPES.get(ch_type, 'str')
+        for field, (_, ch_type) in _FIELD_TYPES.items() if ch_type != 'Date'
+    }
+    _PANDAS_DATE_FIELDS = [field for field, (_, ch_type) in _FIELD_TYPES.items() if ch_type == 'Date']
+
+    # Arrow schema of the table's columns for ArrowStream inserts
+    _ARROW_SCHEMA = pa.schema([
+        (column, ARROW_TYPES[ch_type.partition(' CODEC')[0]]) for column, ch_type in _FIELD_TYPES.values()
+    ]) if pa is not None else None
+
+    # Arrow types for the CSV reader, so it does no type inference; array
+    # literals are read as strings and turned into lists afterwards, and
+    # low-cardinality text is dictionary-encoded
+    _CSV_COLUMN_TYPES = {
+        field: pa.large_string() if pa.types.is_list(arrow_field.type)
+        else pa.dictionary(pa.int32(), arrow_field.type) if field in CATEGORICAL_FIELDS
+        else arrow_field.type
+        for field, arrow_field in zip(_FIELD_TYPES, _ARROW_SCHEMA or ())
+    }
+
+    # Detected fields are cached per counter for a week (--refresh-fields skips the cache)
+    FIELD_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ym_to_clickhouse')
+    FIELD_CACHE_TTL = 7 * 24 * 60 * 60
+
+    # Parts downloaded in parallel; kept low to stay within API rate limits
+    DOWNLOAD_WORKERS = 4
+
+    # Rows per INSERT and INSERTs in flight (ch_batch_rows / ch_batch_concurrency)
+    CH_BATCH_ROWS = 100_000
+    CH_BATCH_CONCURRENCY = 2
+
+    # Attempts per INSERT batch before the upload fails
+    UPLOAD_RETRIES = 3
+
+    # Log request statuses that are still being worked on / that ended in failure
+    PENDING_STATUSES = frozenset({'created', 'processing'})
+    FAILED_STATUSES = frozenset({'processing_failed', 'canceled'})
 
     def __init__(self, config):
         """
@@ -106,6 +210,11 @@ class YMToClickHouseLoader:
         self.api_host = 'https://api-metrika.yandex.ru'
         self.ch_client = None
         self.available_fields = None  # Will be populated after field detection
+        self._fields_csv = self._FIELDS_CSV
+        self._sorted_fields_csv = self._FIELDS_CSV_SORTED
+        self._session = ym_session(config.get('ym_token'))
+        self._evaluation_cache = {}  # frozenset of fields -> evaluate outcome
+        self._fields_from_cache = False
 
     def validate_config(self):
         """Validate required configuration parameters"""
@@ -156,13 +265,22 @@ class YMToClickHouseLoader:
         """
         Automatically detect which fields are available for the counter.
         Tests each field and filters out unavailable ones.
+
+        A result cached on disk for this counter is reused unless
+        refresh_fields is set or the cache is older than FIELD_CACHE_TTL.
         """
-        logger.info("Detecting available fields for the counter...")
+        if not self.config.get('refresh_fields'):
+            cached = self._load_cached_fields()
+            if cached is not None:
+                self._set_available_fields(cached)
+                self._fields_from_cache = True
+                logger.info(f"Using {len(self.available_fields)} available fields (cached)")
+                return self.available_fields
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
+        logger.info("Detecting available fields for the counter...")
+        self._fields_from_cache = False
+        # Only a conclusive detection is cached, not a fallback guess
+        detected = True
 
         # Start with minimal required fields that should always be available
         base_fields = ['ym:s:visitID', 'ym:s:date', 'ym:s:clientID']
@@ -178,7 +296,7 @@ class YMToClickHouseLoader:
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
 
         try:
-            response = requests.get(url, headers=header_dict, timeout=30)
+            response = self._session.get(url, timeout=30)
             if response.status_code != 200:
                 raise YandexMetricaAPIError(f"Cannot access counter API: {response.status_code}")
         except requests.RequestException as e:
@@ -205,7 +323,7 @@ class YMToClickHouseLoader:
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
 
         try:
-            response = requests.get(url, headers=header_dict, timeout=30)
+            response = self._session.get(url, timeout=30)
 
             if response.status_code == 200:
                 # All fields are available
@@ -216,12 +334,11 @@ class YMToClickHouseLoader:
                 logger.info("Some fields are unavailable, testing individually...")
 
                 # Extract field name from error if possible
-                error_data = response.json() if response.status_code == 400 else {}
+                error_data = json_loads(response.content) if response.status_code == 400 else {}
                 error_message = error_data.get('message', '')
 
                 # Try to extract unavailable field from error message
-                import re
-                match = re.search(r'ym:s:\w+', error_message)
+                match = FIELD_ERROR_RE.search(error_message)
                 if match:
                     unavailable_field = match.group(0)
                     logger.info(f"Identified unavailable field from error: {unavailable_field}")
@@ -240,15 +357,15 @@ class YMToClickHouseLoader:
                         ])
 
                         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
-                        response = requests.get(url, headers=header_dict, timeout=30)
+                        response = self._session.get(url, timeout=30)
 
                         if response.status_code == 200:
                             available = test_fields
                             break
                         else:
-                            error_data = response.json() if response.status_code == 400 else {}
+                            error_data = json_loads(response.content) if response.status_code == 400 else {}
                             error_message = error_data.get('message', '')
-                            match = re.search(r'ym:s:\w+', error_message)
+                            match = FIELD_ERROR_RE.search(error_message)
                             if match:
                                 unavailable_field = match.group(0)
                                 if unavailable_field not in unavailable:
@@ -259,69 +376,167 @@ class YMToClickHouseLoader:
                                 # Can't identify the problematic field, give up
                                 logger.warning("Cannot identify unavailable field, using base fields only")
                                 available = base_fields
+                                detected = False
                                 break
                 else:
-                    # Fallback: test each field individually
-                    logger.info("Testing fields individually (this may take a while)...")
-                    for field in remaining_fields:
-                        test_fields = base_fields + [field]
-                        url_params = urlencode([
-                            ('date1', self.config['start_date']),
-                            ('date2', self.config['end_date']),
-                            ('source', 'visits'),
-                            ('fields', ','.join(test_fields))
-                        ])
-
-                        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
-                        response = requests.get(url, headers=header_dict, timeout=10)
-
-                        if response.status_code == 200:
-                            available.append(field)
-                        else:
-                            unavailable.append(field)
+                    # Fallback: narrow the failing fields down by bisection
+                    logger.info("Searching for unavailable fields by bisection...")
+                    found, conclusive = self._find_unavailable_fields(base_fields, remaining_fields)
+                    unavailable.extend(found)
+                    available.extend(f for f in remaining_fields if f not in unavailable)
+                    # The request failed for a reason not pinned on a named field,
+                    # so this field list is a guess and is not cached
+                    if not found or not conclusive:
+                        logger.warning("Could not identify all unavailable fields by bisection")
+                        detected = False
 
         except requests.RequestException as e:
             logger.warning(f"Error during field detection: {e}, using all fields")
             available = list(self.API_FIELDS)
+            detected = False
 
-        self.available_fields = tuple(available)
+        self._set_available_fields(available)
+        if detected:
+            self._save_cached_fields()
 
         if unavailable:
-            logger.warning(f"Removed {len(unavailable)} unavailable fields: {', '.join([f.split(':')[-1] for f in unavailable])}")
+            logger.warning(f"Removed {len(unavailable)} unavailable fields: {', '.join([self._FIELD_TYPES[f][0] for f in unavailable])}")
 
         logger.info(f"Using {len(self.available_fields)} available fields")
 
         return self.available_fields
 
+    def _set_available_fields(self, fields):
+        """Store the available fields along with their order for log requests"""
+        self.available_fields = tuple(fields)
+        self._fields_csv = ','.join(self.available_fields)
+        # create_logs_request sends the fields sorted case-insensitively
+        self._sorted_fields_csv = ','.join(sorted(self.available_fields, key=str.lower))
+
+    def _field_cache_path(self):
+        """Path of the field cache file for the configured counter"""
+        return os.path.join(self.FIELD_CACHE_DIR, f"fields_{self.config['ym_counter_id']}.json")
+
+    def _load_cached_fields(self):
+        """Return cached available fields younger than FIELD_CACHE_TTL, or None"""
+        try:
+            with open(self._field_cache_path(), 'rb') as f:
+                entry = json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+        # A cache written for a different API_FIELDS list is stale
+        if entry.get('api_fields') != list(self.API_FIELDS):
+            return None
+        if time.time() - entry.get('time', 0) >= self.FIELD_CACHE_TTL:
+            return None
+        return tuple(entry['available'])
+
+    def _save_cached_fields(self):
+        """Store the detected fields in the field cache, replacing the file atomically"""
+        path = self._field_cache_path()
+        entry = {
+            'time': time.time(),
+            'api_fields': list(self.API_FIELDS),
+            'available': list(self.available_fields)
+        }
+        try:
+            os.makedirs(self.FIELD_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write field cache: {e}")
+
+    def _find_unavailable_fields(self, base_fields, fields):
+        """
+        Find the unavailable fields among fields that fail together.
+
+        The fields are split in half and both halves are probed in
+        parallel; only halves the API refuses with an error naming one of
+        their fields are split further. With K broken fields this takes
+        about 2*K*log2(N) evaluate requests instead of one per field.
+
+        Returns:
+            tuple: (unavailable fields in their original order, conclusive),
+            conclusive being False when a probe failed without naming a
+            field or a refused half held no single refused field
+        """
+        mid = len(fields) // 2
+        halves = [half for half in (fields[:mid], fields[mid:]) if half]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            outcomes = list(executor.map(lambda half: self._evaluate_fields(base_fields + half), halves))
+            unavailable = {half[0] for half, outcome in zip(halves, outcomes) if outcome == 'refused' and len(half) == 1}
+            refused = [half for half, outcome in zip(halves, outcomes) if outcome == 'refused' and len(half) > 1]
+            conclusive = 'failed' not in outcomes
+
+            for found, nested_conclusive in executor.map(lambda half: self._find_unavailable_fields(base_fields, half), refused):
+                unavailable.update(found)
+                conclusive = conclusive and nested_conclusive and bool(found)
+
+        return [field for field in fields if field in unavailable], conclusive
+
+    def _evaluate_fields(self, fields):
+        """
+        Check via the evaluate endpoint whether the fields can be requested together.
+
+        Returns:
+            str: 'possible'; 'refused' when the API rejects the request with
+            an error naming one of the fields; 'failed' for anything else
+        """
+        cache_key = frozenset(fields)
+        if cache_key in self._evaluation_cache:
+            return self._evaluation_cache[cache_key]
+
+        url_params = urlencode([
+            ('date1', self.config['start_date']),
+            ('date2', self.config['end_date']),
+            ('source', 'visits'),
+            ('fields', ','.join(fields))
+        ])
+
+        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
+        response = self._session.get(url, timeout=10)
+
+        outcome = 'failed'
+        if response.status_code == 200:
+            outcome = 'possible'
+        elif response.status_code == 400:
+            # Not JSON (ValueError) or not a JSON object (AttributeError)
+            try:
+                message = json_loads(response.content).get('message', '')
+            except (ValueError, AttributeError):
+                message = ''
+            if not set(FIELD_ERROR_RE.findall(message)).isdisjoint(fields):
+                outcome = 'refused'
+
+        self._evaluation_cache[cache_key] = outcome
+        return outcome
+
     def check_logs_api_availability(self):
         """Check if Logs API request can be created"""
         logger.info("Checking Logs API availability...")
 
         # Use detected available fields or fall back to all fields
-        fields_to_use = self.available_fields if self.available_fields else self.API_FIELDS
-
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
-
         url_params = urlencode([
             ('date1', self.config['start_date']),
             ('date2', self.config['end_date']),
             ('source', 'visits'),
-            ('fields', ','.join(fields_to_use))
+            ('fields', self._fields_csv)
         ])
 
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests/evaluate?{url_params}"
 
         try:
-            response = requests.get(url, headers=header_dict, timeout=30)
+            response = self._session.get(url, timeout=30)
 
             # Check for errors and provide detailed error message
             if response.status_code != 200:
                 error_msg = f"API returned status {response.status_code}"
                 try:
-                    error_data = response.json()
+                    error_data = json_loads(response.content)
                     if 'message' in error_data:
                         error_msg += f": {error_data['message']}"
                     if 'errors' in error_data:
@@ -330,7 +545,7 @@ class YMToClickHouseLoader:
                     error_msg += f". Response: {response.text[:200]}"
                 raise YandexMetricaAPIError(error_msg)
 
-            result = response.json().get('log_request_evaluation', {})
+            result = json_loads(response.content).get('log_request_evaluation', {})
 
             if not result.get('possible', False):
                 raise YandexMetricaAPIError("Logs API request is not possible for the specified parameters")
@@ -346,30 +561,23 @@ class YMToClickHouseLoader:
         logger.info("Creating Logs API request...")
 
         # Use detected available fields or fall back to all fields
-        fields_to_use = self.available_fields if self.available_fields else self.API_FIELDS
-
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
-
         url_params = urlencode([
             ('date1', self.config['start_date']),
             ('date2', self.config['end_date']),
             ('source', 'visits'),
-            ('fields', ','.join(sorted(fields_to_use, key=lambda s: s.lower())))
+            ('fields', self._sorted_fields_csv)
         ])
 
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequests?{url_params}"
 
         try:
-            response = requests.post(url, headers=header_dict, timeout=30)
+            response = self._session.post(url, timeout=30)
 
             # Check for errors and provide detailed error message
             if response.status_code != 200:
                 error_msg = f"API returned status {response.status_code}"
                 try:
-                    error_data = response.json()
+                    error_data = json_loads(response.content)
                     if 'message' in error_data:
                         error_msg += f": {error_data['message']}"
                     if 'errors' in error_data:
@@ -378,7 +586,7 @@ class YMToClickHouseLoader:
                     error_msg += f". Response: {response.text[:200]}"
                 raise YandexMetricaAPIError(error_msg)
 
-            request_id = response.json()['log_request']['request_id']
+            request_id = json_loads(response.content)['log_request']['request_id']
             logger.info(f"Logs API request created with ID: {request_id}")
             return request_id
 
@@ -389,28 +597,37 @@ class YMToClickHouseLoader:
         """Wait for Logs API request to be processed"""
         logger.info(f"Waiting for request {request_id} to be processed...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
-
         url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}"
 
         start_time = time.time()
         max_wait_seconds = max_wait_minutes * 60
 
+        # Poll quickly at first so small requests are picked up early, then back
+        # off exponentially (poll_delay); the backoff restarts whenever the
+        # status changes, and a Retry-After from the API takes precedence
+        attempts = 0
+        retry_after = None
+
         status = 'created'
-        while status == 'created' or status == 'processing':
+        while status in self.PENDING_STATUSES:
             if time.time() - start_time > max_wait_seconds:
                 raise YandexMetricaAPIError(f"Request processing timeout after {max_wait_minutes} minutes")
 
-            time.sleep(10)  # Check every 10 seconds
+            time.sleep(retry_after if retry_after is not None else poll_delay(attempts))
+            attempts += 1
 
             try:
-                response = requests.get(url, headers=header_dict, timeout=30)
+                response = self._session.get(url, timeout=30)
                 response.raise_for_status()
 
-                log_request = response.json()['log_request']
+                try:
+                    retry_after = float(response.headers['Retry-After'])
+                except (KeyError, ValueError):
+                    retry_after = None
+
+                log_request = json_loads(response.content)['log_request']
+                if log_request['status'] != status:
+                    attempts = 0
                 status = log_request['status']
 
                 logger.info(f"Request status: {status}")
@@ -418,49 +635,145 @@ class YMToClickHouseLoader:
                 if status == 'processed':
                     logger.info(f"Request processed successfully. Parts: {len(log_request.get('parts', []))}")
                     return log_request
-                elif status == 'processing_failed' or status == 'canceled':
+                elif status in self.FAILED_STATUSES:
                     raise YandexMetricaAPIError(f"Request processing failed with status: {status}")
 
             except requests.RequestException as e:
                 raise YandexMetricaAPIError(f"Failed to check request status: {e}")
 
-    def download_data(self, request_id, parts):
-        """Download data from processed Logs API request"""
+    def download_and_upload(self, request_id, parts, raw=False):
+        """
+        Download parts and upload each one as soon as it is downloaded.
+
+        Downloader threads put finished parts into a bounded queue and the
+        calling thread takes them off and uploads them, so downloading from
+        the Logs API and inserting into ClickHouse overlap. The queue holds
+        at most 2 * ch_batch_concurrency parts, which bounds memory when
+        uploads are slower than downloads. Parts are uploaded in the order
+        they finish.
+
+        Args:
+            raw: pass the TSV through as is instead of parsing it
+        """
         logger.info(f"Downloading data from {len(parts)} parts...")
 
-        header_dict = {
-            'Authorization': f'OAuth {self.config["ym_token"]}',
-            'Content-Type': 'application/x-yametrika+json'
-        }
+        if not parts:
+            raise YandexMetricaAPIError("No data downloaded")
 
-        dataframes = []
+        download = self._download_raw_part if raw else self._download_part
+        upload = self.upload_raw_to_clickhouse if raw else self.upload_to_clickhouse
 
-        for part in parts:
-            part_num = part['part_number']
-            logger.info(f"Downloading part {part_num}...")
+        downloaded = queue.Queue(maxsize=2 * self._batch_concurrency())
+        stop = threading.Event()
 
-            url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}/part/{part_num}/download"
+        def release(data):
+            # A raw part is a memory-mapped spool file, closed as soon as it
+            # has been uploaded or will not be
+            if isinstance(data, mmap.mmap):
+                data.close()
 
+        def produce(part):
             try:
-                response = requests.get(url, headers=header_dict, timeout=300)
+                item = (download(request_id, part), None)
+            except Exception as e:
+                item = (None, e)
+            # Give up instead of blocking forever once the upload side failed
+            while not stop.is_set():
+                try:
+                    downloaded.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+            release(item[0])
+
+        total_rows = 0
+        workers = min(self.DOWNLOAD_WORKERS, len(parts))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for part in parts:
+                executor.submit(produce, part)
+
+            for _ in parts:
+                data, error = downloaded.get()
+                if error is not None:
+                    raise error
+                try:
+                    total_rows += upload(data)
+                finally:
+                    release(data)
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            # Parts still queued after an error are never uploaded
+            while not downloaded.empty():
+                release(downloaded.get_nowait()[0])
+
+        logger.info(f"Total rows uploaded: {total_rows}")
+        return total_rows
+
+    def _download_part(self, request_id, part):
+        """Download and parse a single Logs API part"""
+        part_num = part['part_number']
+        logger.info(f"Downloading part {part_num}...")
+
+        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}/part/{part_num}/download"
+
+        # parse_dates fails on a column the part does not have
+        fields = self.available_fields or self.API_FIELDS
+
+        try:
+            with self._session.get(url, timeout=300, stream=True) as response:
                 response.raise_for_status()
+                # Parse straight from the socket; gzip is inflated on the fly
+                response.raw.decode_content = True
+                if pacsv is not None:
+                    data = self._read_arrow(response.raw)
+                else:
+                    data = pd.read_csv(
+                        response.raw, sep='\t', engine='c', encoding='utf-8',
+                        usecols=lambda column: column in self._FIELD_TYPES,
+                        dtype=self._PANDAS_DTYPES,
+                        parse_dates=[field for field in self._PANDAS_DATE_FIELDS if field in fields],
+                        date_format='%Y-%m-%d',
+                        na_filter=False, low_memory=False
+                    )
+            logger.info(f"Part {part_num} downloaded: {len(data)} rows")
+            return data
 
-                df = pd.read_csv(StringIO(response.text), sep='\t')
-                dataframes.append(df)
-                logger.info(f"Part {part_num} downloaded: {len(df)} rows")
+        except requests.RequestException as e:
+            raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
+        except Exception as e:
+            raise YandexMetricaAPIError(f"Failed to parse data from part {part_num}: {e}")
 
-            except requests.RequestException as e:
-                raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
-            except Exception as e:
-                raise YandexMetricaAPIError(f"Failed to parse data from part {part_num}: {e}")
+    def _download_raw_part(self, request_id, part):
+        """
+        Download a single Logs API part as TSV.
 
-        if not dataframes:
-            raise YandexMetricaAPIError("No data downloaded")
+        The part is streamed to a temporary file and returned memory-mapped,
+        so parts waiting for upload are backed by the page cache rather than
+        held in process memory.
+        """
+        part_num = part['part_number']
+        logger.info(f"Downloading part {part_num}...")
+
+        url = f"{self.api_host}/management/v1/counter/{self.config['ym_counter_id']}/logrequest/{request_id}/part/{part_num}/download"
 
-        combined_df = pd.concat(dataframes, ignore_index=True)
-        logger.info(f"Total rows downloaded: {len(combined_df)}")
+        try:
+            with self._session.get(url, timeout=300, stream=True) as response, tempfile.TemporaryFile() as spool:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, spool, 1 << 20)
+                spool.flush()
+                size = spool.tell()
+                logger.info(f"Part {part_num} downloaded: {size} bytes")
 
-        return combined_df
+                # An empty file can't be mapped; the mapping outlives the file
+                if not size:
+                    return b''
+                return mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except requests.RequestException as e:
+            raise YandexMetricaAPIError(f"Failed to download part {part_num}: {e}")
 
     def create_clickhouse_table(self):
         """Create or recreate ClickHouse table dynamically based on available fields"""
@@ -472,63 +785,20 @@ class YMToClickHouseLoader:
         # Use available fields to build dynamic schema
         fields_to_use = self.available_fields if self.available_fields else self.API_FIELDS
 
-        # Define column types for each field
-        field_types = {
-            'ym:s:visitID': 'visitID UInt64',
-            'ym:s:watchIDs': 'watchIDs String',
-            'ym:s:date': 'date Date',
-            'ym:s:isNewUser': 'isNewUser UInt8',
-            'ym:s:startURL': 'startURL String',
-            'ym:s:endURL': 'endURL String',
-            'ym:s:visitDuration': 'visitDuration UInt32',
-            'ym:s:bounce': 'bounce UInt8',
-            'ym:s:clientID': 'clientID UInt64',
-            'ym:s:goalsID': 'goalsID String',
-            'ym:s:goalsDateTime': 'goalsDateTime String',
-            'ym:s:referer': 'referer String',
-            'ym:s:deviceCategory': 'deviceCategory String',
-            'ym:s:operatingSystemRoot': 'operatingSystemRoot String',
-            'ym:s:UTMCampaign': 'UTMCampaign String',
-            'ym:s:UTMContent': 'UTMContent String',
-            'ym:s:UTMMedium': 'UTMMedium String',
-            'ym:s:UTMSource': 'UTMSource String',
-            'ym:s:UTMTerm': 'UTMTerm String',
-            'ym:s:TrafficSource': 'TrafficSource String',
-            'ym:s:pageViews': 'pageViews UInt32',
-            'ym:s:purchaseID': 'purchaseID String',
-            'ym:s:purchaseDateTime': 'purchaseDateTime String',
-            'ym:s:purchaseRevenue': 'purchaseRevenue String',
-            'ym:s:purchaseCurrency': 'purchaseCurrency String',
-            'ym:s:purchaseProductQuantity': 'purchaseProductQuantity String',
-            'ym:s:productsPurchaseID': 'productsPurchaseID String',
-            'ym:s:productsID': 'productsID String',
-            'ym:s:productsName': 'productsName String',
-            'ym:s:productsCategory': 'productsCategory String',
-            'ym:s:regionCity': 'regionCity String',
-            'ym:s:impressionsURL': 'impressionsURL String',
-            'ym:s:impressionsDateTime': 'impressionsDateTime String',
-            'ym:s:impressionsProductID': 'impressionsProductID String',
-            'ym:s:AdvEngine': 'AdvEngine String',
-            'ym:s:ReferalSource': 'ReferalSource String',
-            'ym:s:SearchEngineRoot': 'SearchEngineRoot String',
-            'ym:s:SearchPhrase': 'SearchPhrase String'
-        }
-
         # Build column definitions for available fields
-        column_defs = []
-        for field in fields_to_use:
-            if field in field_types:
-                column_defs.append(f"            {field_types[field]}")
+        column_defs = [f"            {' '.join(self._FIELD_TYPES[field])}" for field in fields_to_use]
 
         columns_str = ',\n'.join(column_defs)
 
-        # Define table schema based on available fields
+        # Define table schema based on available fields. A plain MergeTree
+        # ignores insert_deduplication_token unless the deduplication window
+        # is set, and _upload_batch relies on it to drop resent batches
         create_query = f"""
         CREATE TABLE {table_name} (
 {columns_str}
         ) ENGINE = MergeTree()
         ORDER BY (clientID, date)
-        SETTINGS index_granularity=8192
+        SETTINGS index_granularity=8192, non_replicated_deduplication_window=100
         """
 
         try:
@@ -541,27 +811,192 @@ class YMToClickHouseLoader:
         except Exception as e:
             raise ClickHouseError(f"Failed to create table: {e}")
 
-    def upload_to_clickhouse(self, df):
-        """Upload DataFrame to ClickHouse"""
-        logger.info("Uploading data to ClickHouse...")
+    def upload_to_clickhouse(self, data):
+        """
+        Upload a parsed part from _download_part to ClickHouse; returns its row count.
 
-        # Rename columns to match table schema (remove 'ym:s:' prefix)
-        df_renamed = df.copy()
-        df_renamed.columns = [col.replace('ym:s:', '') for col in df.columns]
+        An Arrow table already has the table's column names and types and is
+        sent as ArrowStream; a DataFrame (no pyarrow) has its columns renamed
+        in place and is sent as TSV.
+        """
+        logger.info("Uploading data to ClickHouse...")
 
         table_name = f"{self.config['ch_database']}.{self.config['ch_table']}"
 
+        batch_rows = self._batch_rows()
+        starts = range(0, max(len(data), 1), batch_rows)
+
         try:
-            # Convert DataFrame to TSV format
-            tsv_data = df_renamed.to_csv(sep='\t', index=False)
+            if pa is None:
+                # Rename columns to match table schema (remove 'ym:s:' prefix).
+                # Only the labels change, so the column data is not copied
+                data.columns = [self._FIELD_TYPES[col][0] for col in data.columns]
+
+                # Convert DataFrame to TSV format, one batch at a time
+                bodies = [
+                    lambda start=start: data.iloc[start:start + batch_rows].to_csv(sep='\t', index=False)
+                    for start in starts
+                ]
+                self._upload_batches(table_name, bodies, 'TabSeparatedWithNames')
+            else:
+                # Columnar Arrow buffers go as is, with no text formatting
+                bodies = [
+                    lambda start=start: iter_arrow_stream(data.slice(start, batch_rows))
+                    for start in starts
+                ]
+                self._upload_batches(table_name, bodies, 'ArrowStream')
+            logger.info(f"Successfully uploaded {len(data)} rows to {table_name}")
+            return len(data)
+
+        except Exception as e:
+            raise ClickHouseError(f"Failed to upload data to ClickHouse: {e}")
 
-            # Upload to ClickHouse
-            self.ch_client.upload(table_name, tsv_data)
-            logger.info(f"Successfully uploaded {len(df)} rows to {table_name}")
+    @classmethod
+    def _read_arrow(cls, stream):
+        """
+        Parse a TSV part with pyarrow's multithreaded CSV reader.
+
+        Columns are read with their final _ARROW_SCHEMA types (integers as
+        narrow unsigned types, date as date32, text as large_string, with
+        CATEGORICAL_FIELDS dictionary-encoded) and renamed to the table's
+        column names; array literals become Arrow lists. The result goes to
+        ClickHouse as is, without pandas.
+        """
+        table = pacsv.read_csv(
+            stream,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=8 << 20),
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(column_types=cls._CSV_COLUMN_TYPES)
+        )
+        table = table.select([field for field in table.column_names if field in cls._FIELD_TYPES])
+        table = table.rename_columns([cls._FIELD_TYPES[field][0] for field in table.column_names])
+        # One dictionary per column for the whole part, as the IPC stream
+        # sent to ClickHouse can't replace a dictionary between batches
+        table = table.unify_dictionaries()
+
+        for i, column in enumerate(table.column_names):
+            field = cls._ARROW_SCHEMA.field(column)
+            if pa.types.is_list(field.type):
+                table = table.set_column(i, field, cls._parse_array_literals(table.column(i), field.type.value_type))
+        return table
+
+    @staticmethod
+    def _parse_array_literals(column, value_type):
+        """Parse API array literals ("[1.5,2]", "['2024-01-01 10:00:00']", "[]") into an Arrow list array"""
+        literals = column.combine_chunks()
+        empty = pc.equal(literals, '[]')
+        items = pc.if_else(empty, pa.scalar(None, pa.large_string()), pc.utf8_slice_codeunits(literals, 1, -1))
+        lists = pc.split_pattern(items, ',')
+        lists = pc.fill_null(lists, pa.scalar([], lists.type))
+        values = pc.utf8_trim(lists.flatten(), "'")
+        if pa.types.is_decimal(value_type):
+            # A direct cast refuses values with more fractional digits than the
+            # column keeps, so they are parsed wide and rounded to its scale
+            values = pc.round(pc.cast(values, pa.decimal128(38, 18)), value_type.scale,
+                              round_mode='half_towards_infinity')
+        values = pc.cast(values, value_type)
+        return pa.ListArray.from_arrays(lists.offsets, values)
+
+    def upload_raw_to_clickhouse(self, buffer):
+        """
+        Upload a raw TSV part from _download_raw_part to ClickHouse as is; returns its row count.
+
+        Only the header line is rewritten, with the 'ym:s:' prefix removed
+        to match the table's column names.
+        """
+        logger.info("Uploading data to ClickHouse...")
+
+        table_name = f"{self.config['ch_database']}.{self.config['ch_table']}"
+
+        rows_start = buffer.find(b'\n') + 1 or len(buffer)
+        header = buffer[:rows_start].replace(b'ym:s:', b'')
+
+        # Each batch is a byte range of the part, cut after every
+        # ch_batch_rows-th row and sent behind its own copy of the header
+        batch_rows = self._batch_rows()
+        ends = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8, offset=rows_start) == ord('\n')) + 1 + rows_start
+        bounds = [rows_start, *ends[batch_rows - 1::batch_rows].tolist()]
+        if bounds[-1] < len(buffer):
+            bounds.append(len(buffer))
+        # A last row without a trailing newline is still a row
+        rows = len(ends) + ((int(ends[-1]) if len(ends) else rows_start) < len(buffer))
+        bodies = [
+            lambda start=start, end=end: iter((header, buffer[start:end]))
+            for start, end in zip(bounds, bounds[1:])
+        ]
+
+        try:
+            self._upload_batches(table_name, bodies or [lambda: header], 'TabSeparatedWithNames')
+            logger.info(f"Successfully uploaded {rows} rows to {table_name}")
+            return rows
 
         except Exception as e:
             raise ClickHouseError(f"Failed to upload data to ClickHouse: {e}")
 
+    def _batch_rows(self):
+        """Rows per INSERT, from ch_batch_rows"""
+        return max(1, int(self.config.get('ch_batch_rows') or self.CH_BATCH_ROWS))
+
+    def _insert_settings(self):
+        """
+        ClickHouse settings for an INSERT: async inserts when ch_async_insert is on.
+
+        Off by default, since a backfill already sends large batches. For
+        small incremental loads the server buffers and merges the batches;
+        ch_async_insert_wait=false stops waiting for the flush (errors in it
+        are then not reported back).
+        """
+        if not self.config.get('ch_async_insert'):
+            return None
+        return {
+            'async_insert': 1,
+            'wait_for_async_insert': 1 if self.config.get('ch_async_insert_wait', True) else 0,
+            'async_insert_busy_timeout_ms': 10000,
+            # Async inserts only honor insert_deduplication_token with this on
+            'async_insert_deduplicate': 1
+        }
+
+    def _batch_concurrency(self):
+        """INSERTs in flight, from ch_batch_concurrency"""
+        return max(1, int(self.config.get('ch_batch_concurrency') or self.CH_BATCH_CONCURRENCY))
+
+    def _upload_batches(self, table_name, bodies, data_format):
+        """
+        Run one INSERT per body, ch_batch_concurrency of them at a time.
+
+        Every body is a callable building the request content, so a failed
+        batch is rebuilt and retried on its own rather than resending
+        everything.
+        """
+        with ThreadPoolExecutor(max_workers=self._batch_concurrency()) as executor:
+            futures = [executor.submit(self._upload_batch, table_name, body, data_format) for body in bodies]
+            for future in futures:
+                future.result()
+
+    def _upload_batch(self, table_name, body, data_format):
+        """
+        Upload a single batch, retrying it with backoff on transient failures.
+
+        Only connection errors and 5xx responses are retried: any other
+        ClickHouse error would fail again the same way. Every attempt carries
+        the same insert_deduplication_token, so a retry of a batch that was
+        already written is dropped by the server instead of duplicating rows
+        (the table is created with non_replicated_deduplication_window for
+        that; with async inserts async_insert_deduplicate is set too).
+        """
+        settings = {**(self._insert_settings() or {}), 'insert_deduplication_token': uuid.uuid4().hex}
+        for attempt in range(1, self.UPLOAD_RETRIES + 1):
+            try:
+                return self.ch_client.upload(
+                    table_name, body(), data_format=data_format,
+                    settings=settings, compression=insert_compression(self.config)
+                )
+            except (requests.ConnectionError, ClickHouseHTTPError) as e:
+                if attempt == self.UPLOAD_RETRIES or getattr(e, 'status_code', 500) < 500:
+                    raise
+                logger.warning(f"Upload batch failed (attempt {attempt}/{self.UPLOAD_RETRIES}): {e}")
+                time.sleep(2 ** attempt)
+
     def run(self):
         """Execute the full ETL process"""
         try:
@@ -577,7 +1012,16 @@ class YMToClickHouseLoader:
             self.detect_available_fields()
 
             # Check Logs API availability
-            self.check_logs_api_availability()
+            try:
+                self.check_logs_api_availability()
+            except YandexMetricaAPIError as e:
+                if not self._fields_from_cache:
+                    raise
+                # The counter's fields may have changed since they were cached
+                logger.warning(f"Logs API check failed with cached fields ({e}), detecting fields again...")
+                self.config['refresh_fields'] = True
+                self.detect_available_fields()
+                self.check_logs_api_availability()
 
             # Create Logs API request
             request_id = self.create_logs_request()
@@ -585,14 +1029,16 @@ class YMToClickHouseLoader:
             # Wait for processing
             log_request = self.wait_for_request_processing(request_id)
 
-            # Download data
-            df = self.download_data(request_id, log_request['parts'])
-
-            # Create ClickHouse table
+            # Create ClickHouse table; it only depends on the fields, so the
+            # parts are uploaded while the rest are still downloading
+            if not log_request['parts']:
+                raise YandexMetricaAPIError("No data downloaded")
             self.create_clickhouse_table()
 
-            # Upload to ClickHouse
-            self.upload_to_clickhouse(df)
+            # Download and upload data: with validate the parts are parsed and
+            # checked against the column types with pyarrow (pandas without
+            # it), otherwise the TSV from the API goes to ClickHouse as is
+            self.download_and_upload(request_id, log_request['parts'], raw=not self.config.get('validate'))
 
             logger.info("Data load completed successfully!")
             return True
@@ -608,8 +1054,8 @@ class YMToClickHouseLoader:
 def load_config_from_file(config_path):
     """Load configuration from JSON file"""
     try:
-        with open(config_path, 'r') as f:
-            return json.load(f)
+        with open(config_path, 'rb') as f:
+            return json_loads(f.read())
     except FileNotFoundError:
         logger.error(f"Configuration file not found: {config_path}")
         sys.exit(1)
@@ -630,7 +1076,14 @@ def load_config_from_env():
         'ch_pass': os.getenv('CH_PASS'),
         'ch_cacert': os.getenv('CH_CACERT', 'YandexInternalRootCA.crt'),
         'ch_database': os.getenv('CH_DATABASE', 'default'),
-        'ch_table': os.getenv('CH_TABLE', 'ym_visits')
+        'ch_table': os.getenv('CH_TABLE', 'ym_visits'),
+        'validate': os.getenv('VALIDATE', 'false').lower() == 'true',
+        'ch_batch_rows': int(os.getenv('CH_BATCH_ROWS', '100000')),
+        'ch_batch_concurrency': int(os.getenv('CH_BATCH_CONCURRENCY', '2')),
+        'ch_async_insert': os.getenv('CH_ASYNC_INSERT', 'false').lower() == 'true',
+        'ch_async_insert_wait': os.getenv('CH_ASYNC_INSERT_WAIT', 'true').lower() == 'true',
+        'refresh_fields': os.getenv('REFRESH_FIELDS', 'false').lower() == 'true',
+        'ch_compression': os.getenv('CH_COMPRESSION')
     }
 
 
@@ -663,6 +1116,18 @@ Examples:
         default=None
     )
 
+    parser.add_argument(
+        '--validate',
+        action='store_true',
+        help='Parse and type-check the downloaded data before uploading'
+    )
+
+    parser.add_argument(
+        '--refresh-fields',
+        action='store_true',
+        help='Detect available fields again instead of using the cached result'
+    )
+
     args = parser.parse_args()
 
     # Load configuration
@@ -671,6 +1136,11 @@ Examples:
     else:
         config = load_config_from_env()
 
+    if args.validate:
+        config['validate'] = True
+    if args.refresh_fields:
+        config['refresh_fields'] = True
+
     # Create loader and run
     loader = YMToClickHouseLoader(config)
     success = loader.run()
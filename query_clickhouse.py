@@ -16,6 +16,12 @@ import pandas as pd
 from tabulate import tabulate
 from colorama import init, Fore, Style
 
+try:
+    import pyarrow as pa
+except ImportError:
+    # Without pyarrow, results are parsed by pandas into NumPy-backed columns
+    pa = None
+
 from some_funcs import simple_ch_client
 
 # Initialize colorama for cross-platform colored output
@@ -28,6 +34,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Separator line around results and the interactive mode banner
+BANNER = f"{Fore.CYAN}{'=' * 80}{Style.RESET_ALL}"
+
 
 class ClickHouseQueryError(Exception):
     """Custom exception for ClickHouse query errors"""
@@ -94,7 +103,11 @@ class BeautifulClickHouseViewer:
 
             logger.info(f"Executing query: {sql_query[:100]}...")
 
-            df = self.ch_client.get_clickhouse_df(sql_query)
+            # With pyarrow the result is parsed straight into Arrow-backed columns
+            if pa is not None:
+                df = self.ch_client.get_clickhouse_arrow_df(sql_query)
+            else:
+                df = self.ch_client.get_clickhouse_df(sql_query)
 
             logger.info(f"Query returned {len(df)} rows, {len(df.columns)} columns")
 
@@ -103,7 +116,7 @@ class BeautifulClickHouseViewer:
         except Exception as e:
             raise ClickHouseQueryError(f"Query execution failed: {e}")
 
-    def display_dataframe(self, df, table_format='grid', max_col_width=50):
+    def display_dataframe(self, df, table_format='grid', max_col_width=50, max_rows=1000):
         """
         Display DataFrame in a beautiful format
 
@@ -111,25 +124,34 @@ class BeautifulClickHouseViewer:
             df (pd.DataFrame): DataFrame to display
             table_format (str): Table format for tabulate
             max_col_width (int): Maximum column width for display
+            max_rows (int): Maximum number of rows to display
         """
         if df.empty:
             print(f"\n{Fore.YELLOW}No data to display{Style.RESET_ALL}\n")
             return
 
         # Print header
-        print(f"\n{Fore.CYAN}{'=' * 80}{Style.RESET_ALL}")
+        print(f"\n{BANNER}")
         print(f"{Fore.GREEN}Query Results{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}{'=' * 80}{Style.RESET_ALL}\n")
+        print(f"{BANNER}\n")
 
         # Print shape info
         print(f"{Fore.YELLOW}Shape: {df.shape[0]} rows × {df.shape[1]} columns{Style.RESET_ALL}\n")
 
-        # Truncate long strings for better display
-        df_display = df.copy()
-        for col in df_display.select_dtypes(include=['object']):
-            df_display[col] = df_display[col].apply(
-                lambda x: (str(x)[:max_col_width] + '...') if isinstance(x, str) and len(str(x)) > max_col_width else x
-            )
+        # Only the first max_rows rows are formatted and shown
+        df_display = df.head(max_rows)
+
+        # Truncate long strings for better display; only the columns that
+        # have long strings are replaced, the rest are not copied
+        truncated = {}
+        for col in df_display.select_dtypes(include=['object', 'string']):
+            values = df_display[col]
+            # Arrow-backed columns give NA rather than False for nulls
+            is_long = (values.str.len() > max_col_width).fillna(False)
+            if is_long.any():
+                truncated[col] = values.mask(is_long, values.str.slice(0, max_col_width) + '...')
+        if truncated:
+            df_display = df_display.assign(**truncated)
 
         # Display using tabulate
         table = tabulate(
@@ -143,8 +165,11 @@ class BeautifulClickHouseViewer:
 
         print(table)
 
+        if len(df) > max_rows:
+            print(f"\n{Fore.YELLOW}Showing first {max_rows} of {len(df)} rows{Style.RESET_ALL}")
+
         # Print footer
-        print(f"\n{Fore.CYAN}{'=' * 80}{Style.RESET_ALL}\n")
+        print(f"\n{BANNER}\n")
 
     def display_statistics(self, df):
         """
@@ -158,21 +183,13 @@ class BeautifulClickHouseViewer:
 
         print(f"{Fore.GREEN}Column Information:{Style.RESET_ALL}\n")
 
-        # Column types and non-null counts
-        info_data = []
-        for col in df.columns:
-            dtype = df[col].dtype
-            non_null = df[col].notna().sum()
-            null = df[col].isna().sum()
-            null_pct = (null / len(df) * 100) if len(df) > 0 else 0
-
-            info_data.append([
-                col,
-                str(dtype),
-                non_null,
-                null,
-                f"{null_pct:.1f}%"
-            ])
+        # Column types and non-null counts, counted for all columns at once
+        non_null = df.notna().sum()
+        null = len(df) - non_null
+        info_data = [
+            [col, str(dtype), col_non_null, col_null, f"{col_null / len(df) * 100:.1f}%"]
+            for col, dtype, col_non_null, col_null in zip(df.columns, df.dtypes, non_null.values, null.values)
+        ]
 
         info_table = tabulate(
             info_data,
@@ -192,9 +209,9 @@ class BeautifulClickHouseViewer:
 
     def run_interactive(self):
         """Run interactive query mode"""
-        print(f"\n{Fore.CYAN}{'=' * 80}{Style.RESET_ALL}")
+        print(f"\n{BANNER}")
         print(f"{Fore.GREEN}Beautiful ClickHouse Query Tool - Interactive Mode{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}{'=' * 80}{Style.RESET_ALL}\n")
+        print(f"{BANNER}\n")
         print("Enter SQL queries (type 'exit' or 'quit' to exit, 'help' for help)\n")
 
         while True:
@@ -250,6 +267,7 @@ class BeautifulClickHouseViewer:
 {Fore.GREEN}Tips:{Style.RESET_ALL}
   - Queries are automatically limited if no LIMIT clause is specified in non-interactive mode
   - Long strings are truncated for better display
+  - At most 1000 rows are displayed
   - Use statistics view to see column information and numeric summaries
         """
         print(help_text)
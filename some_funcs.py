@@ -1,12 +1,49 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+import json
+import time
+import zlib
+import random
+import hashlib
+import logging
+import threading
 import requests
 import pandas as pd
-from io import StringIO
+from io import BytesIO, StringIO
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+try:
+    import pyarrow as pa
+except ImportError:
+    # pyarrow не установлен - вставки в формате ArrowStream недоступны
+    pa = None
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard не установлен - доступно только сжатие gzip
+    zstandard = None
+
+try:
+    # orjson разбирает JSON в несколько раз быстрее модуля json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Функции (класс) для интеграции с ClickHouse
 # Напишем функции для интеграции с ClickHouse: первая функция просто возвращает результат из DataBase, вторая же преобразует его в pandas DataFrame.
 # Также напишем сразу удобную функцию для загрузки данных.
 
+class ClickHouseHTTPError(ValueError):
+    # Ошибка вставки в ClickHouse вместе с HTTP-кодом ответа:
+    # 5xx - сбой сервера, который имеет смысл повторить, остальные коды - нет
+    def __init__(self, text, status_code):
+        super().__init__(text)
+        self.status_code = status_code
+
 class simple_ch_client():
     def __init__(self, CH_HOST, CH_USER, CH_PASS, cacert):
         self.CH_HOST = CH_HOST
@@ -43,19 +80,188 @@ class simple_ch_client():
         df = pd.read_csv(StringIO(data), sep = '\t')
         return df
 
-    def upload(self, table, content, data_format='TabSeparatedWithNames'):
-        content = content.encode('utf-8')
+    def get_clickhouse_arrow_df(self, query, connection_timeout = 1500):
+        # То же, что get_clickhouse_df, но ответ разбирается pyarrow прямо из
+        # байтов (без декодирования в str), а колонки DataFrame хранятся в Arrow
+        r = requests.post(self.CH_HOST, params = {'query': query, 'user': self.CH_USER, 'password':self.CH_PASS}, timeout = connection_timeout, verify=self.cacert)
+        if r.status_code != 200:
+            raise ValueError(r.text)
+        return pd.read_csv(BytesIO(r.content), sep='\t', engine='pyarrow', dtype_backend='pyarrow')
+
+    def upload(self, table, content, data_format='TabSeparatedWithNames', settings=None, compression=None):
+        # content может быть str, bytes или итератором по bytes -
+        # в последнем случае тело запроса отправляется потоком (chunked)
+        # settings - настройки ClickHouse для запроса (например, async_insert)
+        # compression - 'gzip' или 'zstd': тело сжимается на лету и
+        # отправляется с заголовком Content-Encoding
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        headers = {}
+        if compression:
+            content = self._compress(content, compression)
+            headers['Content-Encoding'] = compression
         query_dict = {
                 'query': 'INSERT INTO {table} FORMAT {data_format} '.format(table=table, data_format=data_format),
                 'user': self.CH_USER, 
                 'password':self.CH_PASS
             }
-        r = requests.post(self.CH_HOST, data=content, params=query_dict, verify=self.cacert)
+        if settings:
+            query_dict.update(settings)
+        r = requests.post(self.CH_HOST, data=content, params=query_dict, headers=headers, verify=self.cacert)
         result = r.text
         if r.status_code == 200:
             return result
         else:
-            raise ValueError(r.text)
+            raise ClickHouseHTTPError(r.text, r.status_code)
+
+    @staticmethod
+    def _compress(content, compression):
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd compression requires the zstandard package')
+            compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        elif compression == 'gzip':
+            compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+        else:
+            raise ValueError('Unsupported compression: {}'.format(compression))
+
+        if isinstance(content, bytes):
+            return compressor.compress(content) + compressor.flush()
+
+        def stream():
+            for chunk in content:
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    yield compressed
+            yield compressor.flush()
+        return stream()
+
+#-----------Общие помощники выгрузки из Logs API в ClickHouse---------
+
+# Опрос статуса запроса Logs API: первая задержка и её предел, в секундах
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 30.0
+
+def poll_delay(attempt):
+    # Задержка перед attempt-м опросом (с нуля): 1, 2, 4, 8, 16, 30 с.
+    # Разброс +-20% не даёт параллельным выгрузкам опрашивать API синхронно
+    return min(POLL_INITIAL_DELAY * 2 ** attempt, POLL_MAX_DELAY) * random.uniform(0.8, 1.2)
+
+def ym_session(token, pool_connections=8, pool_maxsize=16):
+    # Keep-alive сессия для всех запросов к Logs API
+    session = requests.Session()
+    session.headers.update({
+        'Authorization': 'OAuth {}'.format(token),
+        'Content-Type': 'application/x-yametrika+json',
+        # Части - это TSV, они сжимаются в разы; предлагаются все кодировки,
+        # которые urllib3 умеет распаковывать (gzip и deflate, а также br и
+        # zstd, если установлены их пакеты)
+        'Accept-Encoding': make_headers(accept_encoding=True)['accept-encoding']
+    })
+
+    # Идемпотентные запросы повторяются при ограничении частоты и ошибках
+    # сервера; Retry-After из ответа 429 соблюдается
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    return session
+
+def insert_compression(config):
+    # Content-Encoding тела INSERT: ch_compression или zstd/gzip - что доступно
+    compression = config.get('ch_compression') or ('zstd' if zstandard is not None else 'gzip')
+    return None if compression == 'none' else compression
+
+def iter_arrow_stream(table, max_chunksize=None):
+    # Тело INSERT в формате ArrowStream: IPC-поток таблицы pyarrow, по куску
+    # на каждый record batch (не больше max_chunksize строк)
+    buffer = BytesIO()
+    with pa.ipc.new_stream(buffer, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=max_chunksize):
+            writer.write_batch(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    # Остаток потока: схема для пустой таблицы и маркер конца
+    yield buffer.getvalue()
+
+#-----------Кэш проверки полей Logs API (общий для export_ym_simple.py и export_ym_complete.py)---------
+
+logger = logging.getLogger(__name__)
+
+# Имя поля в сообщении об ошибке Logs API
+FIELD_ERROR_RE = re.compile(r'ym:(?:s|pv):[A-Za-z_][A-Za-z0-9_]*')
+
+FIELD_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ym_export', 'fields.json')
+FIELD_CACHE_TTL = 24 * 60 * 60
+
+# Запись - это чтение, изменение и замена всего файла; без блокировки
+# параллельные проверки (hits и visits) затирали бы записи друг друга
+_field_cache_lock = threading.Lock()
+
+def _field_cache_key(counter_id, start_date, end_date, source, fields):
+    # Ключ для счётчика, периода, источника и набора полей (порядок полей не важен)
+    key = '|'.join([str(counter_id), start_date, end_date, source, ','.join(sorted(fields))])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _read_field_cache():
+    # Отсутствующий или повреждённый файл - пустой кэш
+    try:
+        with open(FIELD_CACHE_PATH, 'rb') as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def _load_cached_validation(key):
+    # Пара (available, unavailable) моложе FIELD_CACHE_TTL или None
+    entry = _read_field_cache().get(key)
+    if not entry or time.time() - entry['time'] >= FIELD_CACHE_TTL:
+        return None
+    return entry['available'], entry['unavailable']
+
+def _save_cached_validation(key, available, unavailable):
+    # Файл заменяется атомарно (tmp + os.replace), так что читатель никогда
+    # не видит его наполовину записанным; при ошибке записи - OSError
+    with _field_cache_lock:
+        cache = _read_field_cache()
+        cache[key] = {
+            'time': time.time(),
+            'available': list(available),
+            'unavailable': list(unavailable)
+        }
+        os.makedirs(os.path.dirname(FIELD_CACHE_PATH), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(FIELD_CACHE_PATH, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, FIELD_CACHE_PATH)
+
+def validate_fields_cached(config, source, fields, probe):
+    # Проверка полей source через probe(source, fields) с кэшем на FIELD_CACHE_TTL
+    # (отключается cache_field_validation). probe возвращает (available,
+    # unavailable, conclusive); сохраняется только conclusive-результат - где
+    # все недоступные поля отклонены API с ошибкой, называющей поле: любой
+    # другой сбой может быть временным или зависеть от периода
+    use_cache = config.get('cache_field_validation', True)
+    key = _field_cache_key(config['ym_counter_id'], config['start_date'], config['end_date'], source, fields)
+    if use_cache:
+        cached = _load_cached_validation(key)
+        if cached is not None:
+            available, unavailable = cached
+            logger.info('✓ Using cached validation for {}: {} available, {} unavailable'.format(
+                source, len(available), len(unavailable)))
+            return available, unavailable
+
+    logger.info('Validating {} fields for {}...'.format(len(fields), source))
+    available, unavailable, conclusive = probe(source, fields)
+
+    if use_cache and conclusive:
+        try:
+            _save_cached_validation(key, available, unavailable)
+        except OSError as e:
+            logger.warning('Could not write field validation cache: {}'.format(e))
+    return available, unavailable
 
 try:
     import plotly
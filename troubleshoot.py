@@ -5,16 +5,94 @@ Troubleshooting script to diagnose Yandex Metrica API issues.
 This script helps identify common problems before running the full load script.
 """
 
-import json
+import os
 import sys
+import json
+import time
+import hashlib
 import argparse
-from datetime import datetime
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, quote_plus
 import requests
-
-def test_api_access(config):
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson decodes several times faster than the stdlib json module
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Successful evaluate results are cached for a few minutes (--no-cache skips the cache)
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ym_to_clickhouse', 'troubleshoot.json')
+CACHE_TTL = 300
+
+# (connect, read) timeouts in seconds: connecting fails fast (just above the
+# 3 s TCP retransmit), while evaluate may take a while to answer
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT_FAST = 10
+READ_TIMEOUT_EVAL = 30
+
+# Statuses that fail every request for the counter the same way (bad token,
+# no access, no such counter), so no further probe is sent after them
+AUTH_ERROR_STATUSES = frozenset({401, 403, 404})
+
+# Note: DirectPlatform and DirectConditionType removed as they're not available for all counters
+ALL_FIELDS = (
+    'ym:s:visitID', 'ym:s:watchIDs', 'ym:s:date', 'ym:s:isNewUser',
+    'ym:s:startURL', 'ym:s:endURL', 'ym:s:visitDuration', 'ym:s:bounce',
+    'ym:s:clientID', 'ym:s:goalsID', 'ym:s:goalsDateTime', 'ym:s:referer',
+    'ym:s:deviceCategory', 'ym:s:operatingSystemRoot',
+    'ym:s:UTMCampaign', 'ym:s:UTMContent',
+    'ym:s:UTMMedium', 'ym:s:UTMSource', 'ym:s:UTMTerm', 'ym:s:TrafficSource',
+    'ym:s:pageViews', 'ym:s:purchaseID', 'ym:s:purchaseDateTime',
+    'ym:s:purchaseRevenue', 'ym:s:purchaseCurrency', 'ym:s:purchaseProductQuantity',
+    'ym:s:productsPurchaseID', 'ym:s:productsID', 'ym:s:productsName',
+    'ym:s:productsCategory', 'ym:s:regionCity', 'ym:s:impressionsURL',
+    'ym:s:impressionsDateTime', 'ym:s:impressionsProductID', 'ym:s:AdvEngine',
+    'ym:s:ReferalSource', 'ym:s:SearchEngineRoot', 'ym:s:SearchPhrase'
+)
+
+# Just a few basic fields, to tell unavailable fields from no Logs API access
+MINIMAL_FIELDS = (
+    'ym:s:visitID',
+    'ym:s:date',
+    'ym:s:clientID'
+)
+
+# Field lists as ready-to-use (percent-encoded) 'fields' query values
+ALL_FIELDS_PARAM = quote_plus(','.join(ALL_FIELDS), safe=',:')
+MINIMAL_FIELDS_PARAM = quote_plus(','.join(MINIMAL_FIELDS), safe=',:')
+
+def test_api_access(config, use_cache=True):
     """Test basic API access with minimal request"""
     print("\n=== Testing Yandex Metrica API Access ===\n")
 
+    # Checks that need no network come first, so a config that can't work
+    # fails before any request is sent
+    if not check_config(config):
+        return False
+
+    token = config['ym_token']
+
+    # One keep-alive session for all API probes, closed when they are done
+    with requests.Session() as session:
+        session.headers.update({
+            'Authorization': f'OAuth {token}',
+            'Content-Type': 'application/x-yametrika+json'
+        })
+        # Rate limiting, server errors and dropped connections are retried with
+        # backoff (honoring Retry-After); the last response is still reported
+        retry = Retry(
+            total=4, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'], respect_retry_after_header=True, raise_on_status=False
+        )
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry))
+        return test_api_requests(session, config, use_cache)
+
+def check_config(config):
+    """Check the token and the dates without contacting the API"""
     # Test 1: Check token format
     print("1. Checking token format...")
     token = config.get('ym_token', '')
@@ -25,54 +103,22 @@ def test_api_access(config):
         print("   ⚠️  Warning: Token seems too short (might be invalid)")
     print(f"   ✓ Token present (length: {len(token)})")
 
-    # Test 2: Check counter access
-    print("\n2. Testing counter access...")
-    counter_id = config.get('ym_counter_id')
-    api_host = 'https://api-metrika.yandex.ru'
-
-    headers = {
-        'Authorization': f'OAuth {token}',
-        'Content-Type': 'application/x-yametrika+json'
-    }
-
-    try:
-        url = f"{api_host}/management/v1/counter/{counter_id}"
-        response = requests.get(url, headers=headers, timeout=10)
-
-        if response.status_code == 200:
-            counter_info = response.json()
-            print(f"   ✓ Counter found: {counter_info.get('counter', {}).get('name', 'N/A')}")
-        elif response.status_code == 403:
-            print("   ❌ Error: Access denied. Check your token permissions.")
-            return False
-        elif response.status_code == 404:
-            print(f"   ❌ Error: Counter {counter_id} not found.")
-            return False
-        else:
-            print(f"   ❌ Error: API returned status {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"   Details: {error_data.get('message', response.text[:200])}")
-            except:
-                print(f"   Response: {response.text[:200]}")
-            return False
-    except Exception as e:
-        print(f"   ❌ Error: {e}")
-        return False
-
-    # Test 3: Check dates
-    print("\n3. Checking dates...")
+    # Test 2: Check dates
+    print("\n2. Checking dates...")
     start_date = config.get('start_date')
     end_date = config.get('end_date')
+    if not start_date or not end_date:
+        print("   ❌ Error: start_date and end_date are required")
+        return False
 
     try:
-        start = datetime.strptime(start_date, '%Y-%m-%d')
-        end = datetime.strptime(end_date, '%Y-%m-%d')
-        today = datetime.now()
+        start = date.fromisoformat(start_date)
+        end = date.fromisoformat(end_date)
+        today = date.today()
 
         print(f"   Start date: {start_date}")
         print(f"   End date: {end_date}")
-        print(f"   Today: {today.strftime('%Y-%m-%d')}")
+        print(f"   Today: {today.isoformat()}")
 
         if start > today or end > today:
             print("   ⚠️  Warning: Dates are in the future!")
@@ -91,107 +137,107 @@ def test_api_access(config):
         print(f"   ❌ Error: Invalid date format: {e}")
         return False
 
-    # Test 4: Test simple Logs API request
-    print("\n4. Testing Logs API with minimal fields...")
+    return True
 
-    # Try with just a few basic fields first
-    minimal_fields = [
-        'ym:s:visitID',
-        'ym:s:date',
-        'ym:s:clientID'
-    ]
+def test_api_requests(session, config, use_cache=True):
+    """Test counter access and Logs API requests over a shared session"""
+    counter_id = config.get('ym_counter_id')
+    start_date = config.get('start_date')
+    end_date = config.get('end_date')
+    api_host = 'https://api-metrika.yandex.ru'
 
-    from urllib.parse import urlencode
+    counter_url = f"{api_host}/management/v1/counter/{counter_id}"
+    evaluate_url = f"{api_host}/management/v1/counter/{counter_id}/logrequests/evaluate"
 
-    url_params = urlencode([
-        ('date1', start_date),
-        ('date2', end_date),
-        ('source', 'visits'),
-        ('fields', ','.join(minimal_fields))
-    ])
+    # The counter and the all-fields evaluate requests don't depend on each
+    # other, so both are sent right away; results are still reported in order.
+    # Leaving the block waits for a request still in flight after an early
+    # return, so the caller never closes the session under it
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        counter_future = executor.submit(session.get, counter_url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT_FAST))
+        evaluate_future = executor.submit(evaluate_fields, session, evaluate_url, start_date, end_date, ALL_FIELDS_PARAM, use_cache)
+        return report_api_requests(session, config, evaluate_url, counter_future, evaluate_future, use_cache)
+
+def report_api_requests(session, config, evaluate_url, counter_future, evaluate_future, use_cache=True):
+    """Report the counter and all-fields evaluate results, probing minimal fields if needed"""
+    counter_id = config.get('ym_counter_id')
+    start_date = config.get('start_date')
+    end_date = config.get('end_date')
 
-    url = f"{api_host}/management/v1/counter/{counter_id}/logrequests/evaluate?{url_params}"
+    # Test 3: Check counter access
+    print("\n3. Testing counter access...")
 
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = counter_future.result()
 
         if response.status_code == 200:
-            result = response.json().get('log_request_evaluation', {})
-            if result.get('possible'):
-                print(f"   ✓ Logs API is accessible")
-                print(f"   Expected data size: {result.get('expected_size', 0)} bytes")
-            else:
-                print("   ❌ Error: Logs API reports data is not available")
-                return False
+            counter_info = json_loads(response.content)
+            print(f"   ✓ Counter found: {counter_info.get('counter', {}).get('name', 'N/A')}")
+        elif response.status_code == 403:
+            print("   ❌ Error: Access denied. Check your token permissions.")
+            return False
+        elif response.status_code == 404:
+            print(f"   ❌ Error: Counter {counter_id} not found.")
+            return False
         else:
             print(f"   ❌ Error: API returned status {response.status_code}")
             try:
-                error_data = response.json()
-                print(f"   Message: {error_data.get('message', 'N/A')}")
-                if 'errors' in error_data:
-                    print(f"   Errors: {error_data['errors']}")
-            except:
-                print(f"   Response: {response.text[:300]}")
+                error_data = json_loads(response.content)
+                print(f"   Details: {error_data.get('message', response.text[:200])}")
+            except (ValueError, AttributeError):
+                print(f"   Response: {response.text[:200]}")
             return False
-    except Exception as e:
+    except (requests.RequestException, ValueError) as e:
         print(f"   ❌ Error: {e}")
         return False
 
-    # Test 5: Test with all fields
-    print("\n5. Testing Logs API with all fields...")
-
-    # Note: DirectPlatform and DirectConditionType removed as they're not available for all counters
-    all_fields = [
-        'ym:s:visitID', 'ym:s:watchIDs', 'ym:s:date', 'ym:s:isNewUser',
-        'ym:s:startURL', 'ym:s:endURL', 'ym:s:visitDuration', 'ym:s:bounce',
-        'ym:s:clientID', 'ym:s:goalsID', 'ym:s:goalsDateTime', 'ym:s:referer',
-        'ym:s:deviceCategory', 'ym:s:operatingSystemRoot',
-        'ym:s:UTMCampaign', 'ym:s:UTMContent',
-        'ym:s:UTMMedium', 'ym:s:UTMSource', 'ym:s:UTMTerm', 'ym:s:TrafficSource',
-        'ym:s:pageViews', 'ym:s:purchaseID', 'ym:s:purchaseDateTime',
-        'ym:s:purchaseRevenue', 'ym:s:purchaseCurrency', 'ym:s:purchaseProductQuantity',
-        'ym:s:productsPurchaseID', 'ym:s:productsID', 'ym:s:productsName',
-        'ym:s:productsCategory', 'ym:s:regionCity', 'ym:s:impressionsURL',
-        'ym:s:impressionsDateTime', 'ym:s:impressionsProductID', 'ym:s:AdvEngine',
-        'ym:s:ReferalSource', 'ym:s:SearchEngineRoot', 'ym:s:SearchPhrase'
-    ]
-
-    url_params = urlencode([
-        ('date1', start_date),
-        ('date2', end_date),
-        ('source', 'visits'),
-        ('fields', ','.join(all_fields))
-    ])
-
-    url = f"{api_host}/management/v1/counter/{counter_id}/logrequests/evaluate?{url_params}"
+    # Test 4: Test Logs API with all fields. If that works, the minimal
+    # fields work too, so they are only tried when some fields are rejected
+    print("\n4. Testing Logs API with all fields...")
 
     try:
-        response = requests.get(url, headers=headers, timeout=30)
-
-        if response.status_code == 200:
-            result = response.json().get('log_request_evaluation', {})
-            if result.get('possible'):
-                print(f"   ✓ All fields are available!")
-                print(f"   Expected data size: {result.get('expected_size', 0)} bytes")
-            else:
-                print("   ❌ Error: Some fields are not available for this counter")
-                print("   Suggestion: Try using fewer fields or check which fields are supported")
-                return False
+        ok, result, cached = evaluate_future.result()
+    except (requests.RequestException, ValueError) as e:
+        print(f"   ❌ Error: {e}")
+        return False
+    if cached:
+        print("   (cached)")
+
+    if ok and result.get('possible'):
+        print(f"   ✓ Logs API is accessible")
+        print(f"   ✓ All fields are available!")
+        print(f"   Expected data size: {result.get('expected_size', 0)} bytes")
+    else:
+        if ok:
+            print("   ❌ Error: Some fields are not available for this counter")
+            print("   Suggestion: Try using fewer fields or check which fields are supported")
         else:
-            print(f"   ❌ Error: API returned status {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"   Message: {error_data.get('message', 'N/A')}")
-                if 'errors' in error_data:
-                    print(f"   Errors: {error_data['errors']}")
-                    print("\n   💡 Suggestion: Some e-commerce or advertising fields might not be")
-                    print("      available if those features are not used in your counter.")
-                    print("      Consider removing fields you don't need.")
-            except:
-                print(f"   Response: {response.text[:300]}")
+            print_api_error(result)
+            # Errors that don't name a field won't go away with fewer fields
+            if result.status_code in AUTH_ERROR_STATUSES or 'ym:s:' not in result.text:
+                return False
+            print("\n   💡 Suggestion: Some e-commerce or advertising fields might not be")
+            print("      available if those features are not used in your counter.")
+            print("      Consider removing fields you don't need.")
+
+        # Test 5: Test simple Logs API request
+        print("\n5. Testing Logs API with minimal fields...")
+
+        try:
+            ok, result, cached = evaluate_fields(session, evaluate_url, start_date, end_date, MINIMAL_FIELDS_PARAM, use_cache)
+        except (requests.RequestException, ValueError) as e:
+            print(f"   ❌ Error: {e}")
             return False
-    except Exception as e:
-        print(f"   ❌ Error: {e}")
+        if cached:
+            print("   (cached)")
+
+        if not ok:
+            print_api_error(result)
+        elif result.get('possible'):
+            print(f"   ✓ Logs API is accessible")
+            print(f"   Expected data size: {result.get('expected_size', 0)} bytes")
+        else:
+            print("   ❌ Error: Logs API reports data is not available")
         return False
 
     print("\n" + "="*50)
@@ -199,6 +245,81 @@ def test_api_access(config):
     print("="*50)
     return True
 
+def evaluate_fields(session, evaluate_url, start_date, end_date, fields_param, use_cache=True):
+    """
+    Run a Logs API evaluate request for the given fields (an encoded *_FIELDS_PARAM value)
+
+    Successful results are taken from and stored in the local cache, unless
+    use_cache is False.
+
+    Returns:
+        tuple: (True, log_request_evaluation, cached) on HTTP 200,
+            otherwise (False, response, False)
+    """
+    # The token is part of the key (hashed) as access depends on it
+    cache_key = hashlib.sha1(json.dumps([
+        session.headers.get('Authorization'), evaluate_url, start_date, end_date, fields_param
+    ]).encode()).hexdigest()
+    if use_cache:
+        result = _cache_get(cache_key)
+        if result is not None:
+            return True, result, True
+
+    url_params = urlencode([
+        ('date1', start_date),
+        ('date2', end_date),
+        ('source', 'visits')
+    ])
+
+    response = session.get(f"{evaluate_url}?{url_params}&fields={fields_param}", timeout=(CONNECT_TIMEOUT, READ_TIMEOUT_EVAL))
+    if response.status_code == 200:
+        result = json_loads(response.content).get('log_request_evaluation', {})
+        _cache_put(cache_key, result)
+        return True, result, False
+    return False, response, False
+
+def _load_cache():
+    """Return the cache file contents, or an empty cache"""
+    try:
+        with open(CACHE_PATH, 'rb') as f:
+            cache = json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _cache_get(key):
+    """Return the cached value for key if it is younger than CACHE_TTL, or None"""
+    entry = _load_cache().get(key)
+    if not entry or time.time() - entry.get('ts', 0) >= CACHE_TTL:
+        return None
+    return entry['value']
+
+def _cache_put(key, value):
+    """Store value under key, dropping expired entries and replacing the file atomically"""
+    now = time.time()
+    cache = {k: entry for k, entry in _load_cache().items() if now - entry.get('ts', 0) < CACHE_TTL}
+    cache[key] = {'ts': now, 'value': value}
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp_path = f"{CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError:
+        pass
+
+def print_api_error(response):
+    """Print the status and error details of a failed API response"""
+    print(f"   ❌ Error: API returned status {response.status_code}")
+    # Not JSON (ValueError) or not a JSON object (AttributeError)
+    try:
+        error_data = json_loads(response.content)
+        print(f"   Message: {error_data.get('message', 'N/A')}")
+        if 'errors' in error_data:
+            print(f"   Errors: {error_data['errors']}")
+    except (ValueError, AttributeError):
+        print(f"   Response: {response.text[:300]}")
+
 def main():
     parser = argparse.ArgumentParser(
         description='Troubleshoot Yandex Metrica API connection issues'
@@ -208,12 +329,17 @@ def main():
         required=True,
         help='Path to config.json file'
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Ignore cached Logs API check results and query the API again'
+    )
 
     args = parser.parse_args()
 
     try:
-        with open(args.config, 'r') as f:
-            config = json.load(f)
+        with open(args.config, 'rb') as f:
+            config = json_loads(f.read())
     except FileNotFoundError:
         print(f"Error: Config file not found: {args.config}")
         sys.exit(1)
@@ -221,7 +347,7 @@ def main():
         print(f"Error: Invalid JSON in config file: {e}")
         sys.exit(1)
 
-    success = test_api_access(config)
+    success = test_api_access(config, use_cache=not args.no_cache)
     sys.exit(0 if success else 1)
 
 if __name__ == '__main__':